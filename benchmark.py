@@ -0,0 +1,481 @@
+"""
+Offline benchmark of the forwarding backend.
+
+Replaces bot_backend.client with an in-process fake TelegramClient serving
+synthetic chat histories, with simulated per-call latency and FloodWait replies,
+then drives start_forwarding, clear_chat and get_chats end to end.
+
+Usage:
+    python benchmark.py [--messages 5000] [--latency-ms 5] [--output benchmark_results.json]
+    python benchmark.py --compare benchmark_results.json
+
+Each scenario reports messages/sec, p50/p99 latency (from the moment a message is
+read to the moment the request carrying it completes), API calls by method and
+peak Python memory. Results are written as JSON so runs can be compared over time.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import bot_backend
+from telethon import events
+from telethon.errors import FloodWaitError
+from telethon.tl.types import InputMessagesFilterPhotoVideo
+
+SOURCE_CHAT = -1001000000001
+DESTINATION_CHAT = -1001000000002
+PAGE_SIZE = 100 # Messages Telegram returns per history request
+scratch_dir = None # Config, journal, message index and dialog cache of the scenarios go here
+
+
+# === Synthetic data ===
+class FakeMedia:
+    def __init__(self, kind, size):
+        self.kind = kind
+        self.size = size
+
+
+class FakeMessage:
+    def __init__(self, chat_id, message_id, date, text="", media=None, grouped_id=None):
+        self.chat_id = chat_id
+        self.id = message_id
+        self.date = date
+        self.text = self.message = text
+        self.media = media
+        self.grouped_id = grouped_id
+        kind = media.kind if media else None
+        self.photo = media if kind == "photo" else None
+        self.video = media if kind == "video" else None
+        self.document = media if kind == "document" else None
+        self.audio = media if kind == "audio" else None
+        self.voice = self.video_note = self.gif = self.sticker = None
+
+
+class FakeDialog:
+    def __init__(self, chat_id, name, date):
+        self.id = chat_id
+        self.name = name
+        self.date = date
+        self.pinned = False
+        self.is_channel = True
+        self.is_group = False
+
+
+def generate_history(chat_id, count, media_ratio=0.5, album_ratio=0.1, album_size=4,
+                     mean_size_kb=512, seed=1):
+    """Builds `count` messages: text or media (photo/video/document), some of them grouped in albums."""
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    messages = []
+    message_id = 1
+    grouped_id = 1
+    while len(messages) < count:
+        date = start + datetime.timedelta(seconds=message_id * 30)
+        if rng.random() >= media_ratio:
+            messages.append(FakeMessage(chat_id, message_id, date, text=f"message {message_id}"))
+            message_id += 1
+            continue
+        size = min(album_size, count - len(messages)) if rng.random() < album_ratio else 1
+        group = grouped_id if size > 1 else None
+        grouped_id += 1
+        for _ in range(size):
+            kind = rng.choice(["photo", "video", "document"])
+            media = FakeMedia(kind, int(rng.expovariate(1.0 / (mean_size_kb * 1024))))
+            messages.append(FakeMessage(chat_id, message_id, date, media=media, grouped_id=group))
+            message_id += 1
+    return messages
+
+
+def _matches(message, filter):
+    if filter is None:
+        return True
+    if message.media is None:
+        return False
+    if filter is InputMessagesFilterPhotoVideo:
+        return message.media.kind in ("photo", "video")
+    wanted = {"InputMessagesFilterPhotos": "photo", "InputMessagesFilterVideo": "video",
+              "InputMessagesFilterDocument": "document", "InputMessagesFilterMusic": "audio"}
+    return message.media.kind == wanted.get(filter.__name__)
+
+
+# === Fake client ===
+class FakeTelegramClient:
+    """
+    Just enough of TelegramClient for bot_backend. Every request sleeps for the
+    simulated latency (plus upload time for media), and every `flood_every`-th send
+    fails once with a FloodWait of `flood_seconds`. Long iter_messages reads pause
+    `history_wait` seconds between pages, as Telethon does (1s) for reads over 3000.
+    """
+    def __init__(self, histories, dialogs=(), latency=0.005, upload_mbps=0.0, flood_every=0, flood_seconds=0.0,
+                 history_wait=0.0):
+        self.histories = histories
+        self.dialogs = list(dialogs)
+        self.latency = latency
+        self.upload_mbps = upload_mbps
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.history_wait = history_wait
+        self.calls = collections.Counter()
+        self.flood_waits = 0
+        self.read_at = {} # (chat, message ID) -> time it was handed to the backend
+        self.latencies = []
+        self.handlers = [] # (callback, event) pairs registered by the backend
+        self.captions = [] # Caption of every send_file call, in the order the calls were made
+        self.on_send = None # Called after every successful send_file, to inject live messages
+        self._sends = 0
+        self._next_id = collections.Counter()
+        self._media_owner = {id(m.media): (chat_id, m.id) for chat_id, history in histories.items()
+                             for m in history if m.media is not None}
+
+    async def _request(self, method, delay=0.0, can_flood=False):
+        self.calls[method] += 1
+        if can_flood and self.flood_every:
+            self._sends += 1
+            if self._sends % self.flood_every == 0:
+                self.flood_waits += 1
+                await asyncio.sleep(self.latency)
+                error = FloodWaitError(request=None, capture=0)
+                error.seconds = self.flood_seconds
+                raise error
+        await asyncio.sleep(self.latency + delay)
+
+    def _completed(self, chat_id, ids):
+        now = time.perf_counter()
+        for message_id in ids:
+            read = self.read_at.pop((chat_id, message_id), None)
+            if read is not None:
+                self.latencies.append(now - read)
+
+    def _new_messages(self, chat_id, count):
+        messages = []
+        for _ in range(count):
+            self._next_id[chat_id] += 1
+            messages.append(FakeMessage(chat_id, self._next_id[chat_id], datetime.datetime.now(datetime.timezone.utc)))
+        return messages
+
+    def is_connected(self):
+        return True
+
+    async def disconnect(self):
+        pass
+
+    @property
+    def disconnected(self):
+        return asyncio.sleep(0) # The benchmark ends the run once the backfill is done
+
+    def add_event_handler(self, callback, event=None):
+        self.calls["add_event_handler"] += 1
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        if (callback, event) in self.handlers:
+            self.handlers.remove((callback, event))
+
+    def post_live(self, message):
+        """Delivers a new source message to the registered NewMessage handlers."""
+        self.histories.setdefault(message.chat_id, []).append(message)
+        if message.media is not None:
+            self._media_owner[id(message.media)] = (message.chat_id, message.id)
+        self.read_at[(message.chat_id, message.id)] = time.perf_counter()
+        event = types.SimpleNamespace(chat_id=message.chat_id, message=message)
+        for callback, kind in list(self.handlers):
+            if isinstance(kind, events.NewMessage):
+                asyncio.ensure_future(callback(event))
+
+    async def get_input_entity(self, chat_id):
+        await self._request("get_input_entity")
+        return chat_id
+
+    async def get_messages(self, chat_id, limit=None, ids=None, reverse=False, min_id=0, max_id=0, filter=None, **kwargs):
+        history = self.histories.get(chat_id, [])
+        if ids is not None:
+            await self._request("get_messages")
+            wanted = set(ids)
+            return [m for m in history if m.id in wanted]
+        return [m async for m in self.iter_messages(chat_id, limit=limit, reverse=reverse, min_id=min_id,
+                                                    max_id=max_id, filter=filter)]
+
+    async def iter_messages(self, chat_id, limit=None, reverse=False, min_id=0, max_id=0,
+                            offset_date=None, filter=None, **kwargs):
+        history = self.histories.get(chat_id, [])
+        messages = (m for m in (history if reverse else reversed(history))
+                    if m.id > min_id and (not max_id or m.id < max_id)
+                    and (offset_date is None or m.date < offset_date) and _matches(m, filter))
+        served = 0
+        wait = self.history_wait if limit is None or limit > 3000 else 0.0
+        await self._request("get_history") # Counted even when the page comes back empty
+        for message in messages:
+            if limit is not None and served >= limit:
+                return
+            if served and served % PAGE_SIZE == 0:
+                if wait:
+                    await asyncio.sleep(wait)
+                await self._request("get_history")
+            served += 1
+            self.read_at[(chat_id, message.id)] = time.perf_counter()
+            yield message
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        ids = messages if isinstance(messages, list) else [messages]
+        ids = [getattr(m, "id", m) for m in ids]
+        await self._request("forward_messages", can_flood=True)
+        self._completed(from_peer if from_peer is not None else SOURCE_CHAT, ids)
+        sent = self._new_messages(entity, len(ids))
+        return sent if isinstance(messages, list) else sent[0]
+
+    async def send_file(self, entity, file=None, caption=None, **kwargs):
+        files = file if isinstance(file, list) else [file]
+        size = sum(getattr(f, "size", 0) for f in files)
+        upload = size / (self.upload_mbps * 125000) if self.upload_mbps else 0.0
+        await self._request("send_file", delay=upload, can_flood=True)
+        # Only sends that succeed are recorded: a FloodWait retry must not count twice
+        self.captions.append(caption)
+        if self.on_send is not None:
+            self.on_send()
+        for media in files:
+            owner = self._media_owner.get(id(media))
+            if owner is not None:
+                self._completed(owner[0], [owner[1]])
+        sent = self._new_messages(entity, len(files))
+        return sent if isinstance(file, list) else sent[0]
+
+    async def edit_message(self, entity, message, text=None, file=None, **kwargs):
+        await self._request("edit_message", can_flood=True)
+
+    async def delete_messages(self, entity, message_ids, revoke=True):
+        await self._request("delete_messages", can_flood=True)
+        self._completed(entity, message_ids)
+
+    async def iter_dialogs(self):
+        for index, dialog in enumerate(self.dialogs):
+            if index % PAGE_SIZE == 0:
+                await self._request("get_dialogs")
+            yield dialog
+
+
+# === Scenarios ===
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def _reset_backend(fake):
+    """Fresh backend state and files for each scenario, so no index, cache or bucket leaks between runs."""
+    bot_backend.close_message_index()
+    bot_backend.close_media_cache()
+    bot_backend.close_media_dedup()
+    bot_backend.protected_sources.clear()
+    os.chdir(tempfile.mkdtemp(prefix="scenario_", dir=scratch_dir))
+    bot_backend.client = fake
+    bot_backend.dialog_directory = None
+    bot_backend.entity_cache.clear()
+    bot_backend.rate_limiter = bot_backend.RateLimiter()
+    bot_backend.state_writer = bot_backend.StateWriter()
+
+def _config(args, mode):
+    config = bot_backend.load_configuration()
+    config.update({
+        "source_channel": SOURCE_CHAT,
+        "destination_channel": DESTINATION_CHAT,
+        "prefix": "Benchmark",
+        "count": 1,
+        "rate_limits": {kind: {"rate": args.rate, "burst": args.burst} for kind in ("forward", "send", "delete", "history")},
+        "flood_wait_retries": 10,
+        "pipeline_workers": args.workers,
+        "prefetch_queue_size": args.prefetch,
+        "history_workers": args.history_workers
+    })
+    return config
+
+async def _measure(name, fake, count, run):
+    status_lines = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        await run(status_lines.append)
+    finally:
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    p50 = _percentile(fake.latencies, 0.50)
+    p99 = _percentile(fake.latencies, 0.99)
+    return {
+        "scenario": name,
+        "messages": count,
+        "seconds": round(elapsed, 4),
+        "messages_per_second": round(count / elapsed, 1) if elapsed else None,
+        "latency_p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+        "latency_p99_ms": round(p99 * 1000, 2) if p99 is not None else None,
+        "api_calls": dict(sorted(fake.calls.items())),
+        "api_calls_total": sum(fake.calls.values()),
+        "flood_waits": fake.flood_waits,
+        "status_lines": len(status_lines),
+        "peak_memory_kb": round(peak / 1024, 1)
+    }
+
+def _history(args):
+    return generate_history(SOURCE_CHAT, args.messages, args.media_ratio, args.album_ratio,
+                            args.album_size, args.mean_size_kb, args.seed)
+
+def _fake(args, histories, dialogs=()):
+    return FakeTelegramClient(histories, dialogs, latency=args.latency_ms / 1000.0, upload_mbps=args.upload_mbps,
+                              flood_every=args.flood_every, flood_seconds=args.flood_seconds,
+                              history_wait=args.history_wait)
+
+async def bench_forwarding(args, mode):
+    history = _history(args)
+    fake = _fake(args, {SOURCE_CHAT: history})
+    _reset_backend(fake)
+    config = _config(args, mode)
+    sent = len(history) if mode == '1' else sum(1 for m in history if m.media)
+    name = "forward_original_caption" if mode == '1' else "forward_custom_caption"
+    result = await _measure(name, fake, sent, lambda status: bot_backend.start_forwarding(config, mode, status))
+    bot_backend.close_message_index()
+    return result
+
+async def bench_live_during_backfill(args):
+    """
+    Custom Caption backfill with live media posted while it runs. Live and backfill
+    sends share the caption counter, so every number must be posted exactly once.
+    """
+    history = _history(args)
+    fake = _fake(args, {SOURCE_CHAT: history})
+    _reset_backend(fake)
+    config = _config(args, '2')
+    backfill = sum(1 for m in history if m.media)
+    every = max(1, backfill // (2 * max(1, args.live_messages))) # Spread over the first half of the backfill
+    posted = []
+    def post_live():
+        if len(posted) < args.live_messages and fake.calls["send_file"] % every == 0:
+            message = FakeMessage(SOURCE_CHAT, history[-1].id + len(posted) + 1, datetime.datetime.now(datetime.timezone.utc),
+                                  media=FakeMedia("photo", 1024))
+            posted.append(message)
+            fake.post_live(message)
+    fake.on_send = post_live
+    result = await _measure("forward_live_during_backfill", fake, backfill + args.live_messages,
+                            lambda status: bot_backend.start_forwarding(config, '2', status))
+    bot_backend.close_message_index()
+    numbers = collections.Counter()
+    for caption in fake.captions:
+        for text in (caption if isinstance(caption, list) else [caption]):
+            numbers[int(text.rsplit(" ", 1)[1])] += 1
+    result["live_messages"] = len(posted)
+    result["duplicate_captions"] = sum(1 for n in numbers.values() if n > 1)
+    result["counter_consistent"] = config["count"] == max(numbers, default=0) + 1 == len(numbers) + 1
+    return result
+
+async def bench_clear_chat(args):
+    history = _history(args)
+    fake = _fake(args, {SOURCE_CHAT: history})
+    _reset_backend(fake)
+    bot_backend.rate_limiter.configure(_config(args, '1')["rate_limits"], 10)
+    return await _measure("clear_chat", fake, len(history), lambda status: bot_backend.clear_chat(
+        SOURCE_CHAT, status, concurrency=args.clear_concurrency))
+
+async def bench_get_chats(args):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    dialogs = [FakeDialog(-1002000000000 - i, f"Chat {i % (args.dialogs // 2 or 1)}", now - datetime.timedelta(minutes=i))
+               for i in range(args.dialogs)]
+    fake = _fake(args, {}, dialogs)
+    _reset_backend(fake)
+    results = [await _measure("get_chats_full", fake, len(dialogs), lambda status: bot_backend.get_chats(force_refresh=True))]
+    fake.calls.clear()
+    results.append(await _measure("get_chats_incremental", fake, len(dialogs), lambda status: bot_backend.get_chats()))
+    return results
+
+async def run_benchmarks(args):
+    results = []
+    for mode in ('1', '2'):
+        results.append(await bench_forwarding(args, mode))
+    results.append(await bench_live_during_backfill(args))
+    results.append(await bench_clear_chat(args))
+    results.extend(await bench_get_chats(args))
+    return results
+
+
+# === Reporting ===
+def print_results(results, baseline=None):
+    previous = {r["scenario"]: r for r in (baseline or {}).get("results", [])}
+    for result in results:
+        line = (f"{result['scenario']:<30} {result['messages_per_second'] or 0:>10.1f} msg/s  "
+                f"p50 {result['latency_p50_ms'] if result['latency_p50_ms'] is not None else '-':>8} ms  "
+                f"p99 {result['latency_p99_ms'] if result['latency_p99_ms'] is not None else '-':>8} ms  "
+                f"calls {result['api_calls_total']:>6}  peak {result['peak_memory_kb']:>9.1f} KB")
+        old = previous.get(result["scenario"])
+        if old and old.get("messages_per_second"):
+            change = (result["messages_per_second"] - old["messages_per_second"]) / old["messages_per_second"] * 100
+            line += f"  ({change:+.1f}% vs baseline)"
+        if result.get("duplicate_captions") or result.get("counter_consistent") is False:
+            line += f"  CAPTION NUMBERS REPEATED: {result['duplicate_captions']}"
+        print(line)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the forwarding backend against a fake Telegram client.")
+    parser.add_argument("--messages", type=int, default=5000, help="Messages in the synthetic source history")
+    parser.add_argument("--media-ratio", type=float, default=0.5, help="Share of messages that carry media")
+    parser.add_argument("--album-ratio", type=float, default=0.1, help="Share of media posts that are albums")
+    parser.add_argument("--album-size", type=int, default=4)
+    parser.add_argument("--mean-size-kb", type=int, default=512, help="Mean media size (used with --upload-mbps)")
+    parser.add_argument("--dialogs", type=int, default=2000, help="Dialogs served to get_chats")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated latency of every API call")
+    parser.add_argument("--upload-mbps", type=float, default=0.0, help="Simulated upload bandwidth (0 = instant)")
+    parser.add_argument("--flood-every", type=int, default=0, help="Every N-th send gets a FloodWait (0 = never)")
+    parser.add_argument("--flood-seconds", type=float, default=0.05, help="FloodWait duration in seconds")
+    parser.add_argument("--rate", type=float, default=1000.0, help="Rate limit per destination and request type")
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=1, help="pipeline_workers")
+    parser.add_argument("--prefetch", type=int, default=10, help="prefetch_queue_size")
+    parser.add_argument("--history-workers", type=int, default=4, help="history_workers (ID ranges read at once)")
+    parser.add_argument("--history-wait", type=float, default=0.0,
+                        help="Pause between pages of long sequential reads (Telethon uses 1s)")
+    parser.add_argument("--live-messages", type=int, default=5, help="Live posts sent during the live/backfill scenario")
+    parser.add_argument("--clear-concurrency", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global scratch_dir
+    args = parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output)
+
+    scratch_dir = tempfile.mkdtemp(prefix="forwarder_bench_")
+    cwd = os.getcwd()
+    try:
+        results = asyncio.run(run_benchmarks(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_results(results, baseline)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,56 @@
 import asyncio
+import copy
 import json
 import os
 import sys
+import tempfile
 import threading
 import functools
+import heapq
+import itertools
+import hashlib
 import time
 
 from telethon import TelegramClient, events
-from telethon.tl.functions.messages import DeleteMessagesRequest
-from telethon.errors import SessionPasswordNeededError
+from message_index import MessageIndex, INDEX_FILE
+from dialog_cache import DialogDirectory, DIALOG_CACHE_FILE
+from metrics import metrics
+from chat_archive import ChatArchive, ArchivedMessage, PART_SUFFIX
+from media_cache import MediaCache, MEDIA_CACHE_DIR
+from media_dedup import MediaDedupIndex, MEDIA_DEDUP_FILE
+from telethon.errors import (
+    SessionPasswordNeededError, FloodWaitError, FloodPremiumWaitError, SlowModeWaitError,
+    ChatForwardsRestrictedError, FileReferenceExpiredError, MediaEmptyError
+)
+from telethon.tl.types import (
+    MessageService, InputPeerChannel, InputPeerChat, InputPeerUser, InputMessagesFilterPhotos, InputMessagesFilterVideo, InputMessagesFilterPhotoVideo,
+    InputMessagesFilterDocument, InputMessagesFilterMusic, InputMessagesFilterVoice,
+    InputMessagesFilterRoundVideo, InputMessagesFilterGif, DocumentAttributeVideo, DocumentAttributeAudio,
+    DocumentAttributeAnimated, DocumentAttributeFilename, InputMediaUploadedPhoto, InputMediaUploadedDocument,
+    InputFile, InputFileBig, InputMediaPhoto, InputMediaDocument, InputPhoto, InputDocument
+)
+from telethon.tl.functions.upload import SaveFilePartRequest, SaveBigFilePartRequest
+from telethon.helpers import generate_random_long
 
 # === Constants & Configuration ===
 CONFIG_FILE = "bot_config.json"
+JOURNAL_FILE = "bot_config.journal" # Counter/checkpoint updates not yet folded into CONFIG_FILE
 SESSION_FILE = "forward_bot_session.session"
+MAX_FORWARD_BATCH = 100 # Telegram accepts at most 100 message IDs per forward request
+HISTORY_PAGE_SIZE = 100 # Messages Telegram returns per history or search request
+DOWNLOAD_CHUNK_SIZE = 512 * 1024 # Largest file part Telegram serves; resumed downloads restart on a part boundary
+UPLOAD_PART_SIZE = 512 * 1024 # Largest file part Telegram accepts
+BIG_FILE_SIZE = 10 * 1024 * 1024 # Files above this size are uploaded as "big" files
+# Telegram search filters used to fetch only media messages in Custom Caption mode
+MEDIA_FILTERS = {
+    "photo": InputMessagesFilterPhotos,
+    "video": InputMessagesFilterVideo,
+    "document": InputMessagesFilterDocument,
+    "audio": InputMessagesFilterMusic,
+    "voice": InputMessagesFilterVoice,
+    "round": InputMessagesFilterRoundVideo,
+    "gif": InputMessagesFilterGif
+}
 DEFAULT_CONFIG = {
     "prefix": "Caption",
     "count": 1,
@@ -21,136 +59,2246 @@ DEFAULT_CONFIG = {
     "source_name": "Not Set",
     "destination_name": "Not Set",
     "api_id": None,
-    "api_hash": None
+    "api_hash": None,
+    "forward_batch_size": MAX_FORWARD_BATCH,
+    # Token bucket per destination and request type: refill rate (requests/second) and burst size
+    "rate_limits": {
+        "forward": {"rate": 1.0, "burst": 3},
+        "send": {"rate": 1.0, "burst": 3},
+        "delete": {"rate": 2.0, "burst": 5},
+        "download": {"rate": 2.0, "burst": 4},
+        "history": {"rate": 4.0, "burst": 8}
+    },
+    "flood_wait_retries": 5,
+    # Backfill pipeline: units prefetched ahead of the senders, and number of sender workers
+    "prefetch_queue_size": 10,
+    "pipeline_workers": 1,
+    # History reads of channels: ID ranges fetched concurrently (1 = one sequential cursor),
+    # and IDs per range. Page requests use the "history" rate limit.
+    "history_workers": 4,
+    "history_range_size": 1000,
+    # Full bot_config.json rewrites are batched: at most every N seconds or N progress updates
+    "state_flush_interval": 5.0,
+    "state_flush_every": 50,
+    # Skip source messages that the SQLite message index says were already sent to the destination
+    "duplicate_check": True,
+    "message_index_file": INDEX_FILE,
+    # Propagate later source edits/deletions to the copies (uses the message index)
+    "sync_edits": False,
+    "sync_deletions": False,
+    "edit_debounce_seconds": 1.0,
+    "delete_coalesce_seconds": 1.0,
+    # Media kinds re-posted in Custom Caption mode (keys of MEDIA_FILTERS)
+    "media_kinds": ["photo", "video", "document", "audio", "voice", "round", "gif"],
+    # Last handled source message ID per "source:destination:mode" route
+    "checkpoints": {},
+    # Route table: extra source -> destination pairs served together by start_routes().
+    # Entries hold source_channel, destination_channel, source_name, destination_name, mode,
+    # prefix and count, and may override any of the options above.
+    "routes": [],
+    "max_parallel_backfills": 4,
+    # Delete requests clear_chat keeps in flight at once (still bounded by the "delete" rate limit)
+    "clear_concurrency": 3,
+    # Fan-out (several routes with the same source): messages buffered per destination, and how
+    # long a full destination may hold up the shared read before it is left to catch up on its own
+    "fanout_queue_size": 1000,
+    "fanout_stall_seconds": 30,
+    # Albums: "album" gives a whole album one caption number, "each" numbers every item.
+    # Live album parts are collected for album_window_seconds before they are sent together.
+    "album_numbering": "album",
+    "album_window_seconds": 1.0,
+    # Input peers resolved for the chats in use, keyed by chat ID, so sends skip entity lookups
+    "entities": {},
+    # Counters/histograms (see metrics.py); set metrics_port to serve them at http://<host>:<port>/metrics
+    "metrics_enabled": False,
+    "metrics_host": "127.0.0.1",
+    "metrics_port": None,
+    # Local archive export (see export_chat): parent folder of the archives, concurrent media
+    # downloads, and messages read ahead of the archive writer
+    "archive_dir": "archives",
+    "export_download_workers": 4,
+    "export_queue_size": 50,
+    # Archive import (see import_archive): files uploaded at once, parts in flight per file,
+    # and messages read ahead of the send stage
+    "import_upload_workers": 2,
+    "upload_part_workers": 4,
+    "import_queue_size": 10,
+    # Caption prefix and counter of each Custom Caption import, keyed like its checkpoint
+    "archive_imports": {},
+    # Custom Caption media from chats that forbid forwarding is downloaded and uploaded again.
+    # Downloads are kept in a size-bounded cache, and a file uploaded once is re-sent by reference.
+    "reupload_protected": True,
+    "media_cache_dir": MEDIA_CACHE_DIR,
+    "media_cache_max_mb": 2048,
+    "download_part_workers": 4,
+    # Custom Caption: skip media whose file was already posted to the destination (same photo/
+    # document ID, or same content hash for archive imports), within the last media_dedup_days
+    # (0 = all time). media_dedup_match_size also treats same size + type as the same file.
+    "media_dedup": False,
+    "media_dedup_days": 0,
+    "media_dedup_max_entries": 1000000,
+    "media_dedup_match_size": False,
+    "media_dedup_file": MEDIA_DEDUP_FILE
 }
 
 client = None
+dialog_directory = None
+message_index = None
+entity_cache = {} # Chat ID -> resolved InputPeer
+current_engine = None # The ForwardingEngine that is running, for progress reporting
+active_sessions = set() # ForwardingSessions whose task is running
+media_cache = None
+media_dedup = None
+protected_sources = set() # Source chats that refused a send by reference (forwarding restricted)
+
+# Send priorities: lower values are served first when several requests wait on the same bucket
+PRIORITY_LIVE = 0
+PRIORITY_BACKFILL = 1
+
+
+class RateLimiter:
+    """
+    Adaptive token buckets keyed by (destination, request type).
+
+    Every send goes through call(), which waits for a token before issuing the
+    request. Requests waiting on the same bucket are served by priority (live
+    messages before backfill), then in arrival order. When Telegram answers with
+    a FloodWait, the bucket is blocked for the requested time, its rate is halved
+    and the same request is retried. The rate then creeps back up towards the
+    configured value on success.
+    """
+    MIN_RATE = 0.05
+
+    def __init__(self, limits=None, max_retries=5):
+        self.limits = {}
+        self.max_retries = max_retries
+        self._buckets = {}
+        self._tickets = itertools.count()
+        self.configure(limits or DEFAULT_CONFIG["rate_limits"], max_retries)
+
+    def configure(self, limits, max_retries=None):
+        for kind, limit in (limits or {}).items():
+            self.limits[kind] = (float(limit["rate"]), float(limit.get("burst", 1)))
+        if max_retries is not None:
+            self.max_retries = max_retries
+        self._buckets.clear()
+
+    def _bucket(self, destination, kind):
+        key = (destination, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits.get(kind, (1.0, 1.0))
+            bucket = {"rate": rate, "max_rate": rate, "burst": burst, "tokens": burst,
+                      "updated": time.monotonic(), "blocked_until": 0.0,
+                      "waiters": [], "condition": asyncio.Condition()}
+            self._buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, destination, kind, priority=PRIORITY_BACKFILL):
+        bucket = self._bucket(destination, kind)
+        waiters = bucket["waiters"]
+        condition = bucket["condition"]
+        ticket = (priority, next(self._tickets))
+        async with condition:
+            heapq.heappush(waiters, ticket)
+            condition.notify_all() # A more urgent request may now be first in line
+            try:
+                while True:
+                    delay = None # Not first in line: sleep until the waiters change
+                    if waiters[0] == ticket:
+                        now = time.monotonic()
+                        if now < bucket["blocked_until"]:
+                            delay = bucket["blocked_until"] - now
+                        else:
+                            bucket["tokens"] = min(bucket["burst"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+                            bucket["updated"] = now
+                            if bucket["tokens"] >= 1:
+                                bucket["tokens"] -= 1
+                                heapq.heappop(waiters)
+                                condition.notify_all()
+                                return
+                            delay = (1 - bucket["tokens"]) / bucket["rate"]
+                    try:
+                        await asyncio.wait_for(condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if ticket in waiters:
+                    waiters.remove(ticket)
+                    heapq.heapify(waiters)
+                    condition.notify_all()
+                raise
+
+    def on_flood_wait(self, destination, kind, seconds):
+        bucket = self._bucket(destination, kind)
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.monotonic() + seconds)
+        bucket["tokens"] = 0.0
+        bucket["rate"] = max(self.MIN_RATE, bucket["rate"] / 2)
+
+    def on_success(self, destination, kind):
+        bucket = self._bucket(destination, kind)
+        if bucket["rate"] < bucket["max_rate"]:
+            bucket["rate"] = min(bucket["max_rate"], bucket["rate"] + bucket["max_rate"] * 0.05)
+
+    async def call(self, destination, kind, request, status_callback=None, priority=PRIORITY_BACKFILL):
+        """
+        Runs request() (a zero-argument coroutine function) under the bucket for
+        (destination, kind), retrying it after any FloodWait Telegram reports.
+        """
+        attempt = 0
+        while True:
+            await self.acquire(destination, kind, priority)
+            metrics.inc("api_calls_total", kind=kind)
+            try:
+                result = await request()
+            except (FloodWaitError, FloodPremiumWaitError, SlowModeWaitError) as e:
+                metrics.inc("flood_waits_total", kind=kind)
+                metrics.inc("flood_wait_seconds_total", e.seconds, kind=kind)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.on_flood_wait(destination, kind, e.seconds)
+                if status_callback:
+                    status_callback(f"FloodWait: Telegram asked to wait {e.seconds}s before the next {kind} request. Retrying ({attempt}/{self.max_retries})...")
+                continue
+            self.on_success(destination, kind)
+            return result
+
+
+rate_limiter = RateLimiter()
+
+# Longest FloodWait waited out for requests outside the rate limiter (Telethon's old default threshold)
+FLOOD_SLEEP_MAX = 60
+
+async def _flood_sleep(error, attempt, kind, status_callback=None):
+    """
+    Waits out a FloodWait raised by a request the rate limiter does not manage (the
+    client no longer sleeps through them itself). Re-raises it when it is longer than
+    FLOOD_SLEEP_MAX or after the limiter's number of retries.
+    """
+    metrics.inc("flood_waits_total", kind=kind)
+    metrics.inc("flood_wait_seconds_total", error.seconds, kind=kind)
+    if error.seconds > FLOOD_SLEEP_MAX or attempt > rate_limiter.max_retries:
+        raise error
+    if status_callback:
+        status_callback(f"FloodWait: Telegram asked to wait {error.seconds}s before the next {kind} request. Waiting...")
+    await asyncio.sleep(error.seconds)
 
+async def _call_waiting(request, kind, status_callback=None):
+    """Runs request() (a zero-argument coroutine function), waiting out FloodWaits (see _flood_sleep)."""
+    attempt = 0
+    while True:
+        try:
+            return await request()
+        except (FloodWaitError, FloodPremiumWaitError) as e:
+            attempt += 1
+            await _flood_sleep(e, attempt, kind, status_callback)
+
+
+def _replay_journal(config):
+    if not os.path.exists(JOURNAL_FILE):
+        return
+    with open(JOURNAL_FILE, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break # Torn last line from a crash mid-append
+            if "count" in entry:
+                routes = config.get("routes") or []
+                index = entry.get("route")
+                if index is None:
+                    config["count"] = entry["count"]
+                elif isinstance(index, str): # An archive import (see ArchiveRoute)
+                    config.setdefault("archive_imports", {}).setdefault(index, {})["count"] = entry["count"]
+                elif index < len(routes):
+                    routes[index]["count"] = entry["count"]
+            if "checkpoint" in entry:
+                key, message_id = entry["checkpoint"]
+                config.setdefault("checkpoints", {})[key] = message_id
 
 def load_configuration():
+    config = copy.deepcopy(DEFAULT_CONFIG)
     if os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
-    return DEFAULT_CONFIG.copy()
+            config.update(json.load(f))
+    _replay_journal(config)
+    return config
 
 def save_configuration(config):
+    """Writes the whole configuration atomically (temp file + rename) and folds in the journal."""
     try:
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(config, f, indent=2)
+        directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
+        fd, temp_path = tempfile.mkstemp(prefix=".bot_config.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, CONFIG_FILE)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        if os.path.exists(JOURNAL_FILE):
+            os.remove(JOURNAL_FILE)
     except Exception as e:
         print(f"Error saving configuration: {e}")
 
+
+class StateWriter:
+    """
+    Write-behind persistence for the fast-changing parts of the configuration
+    (caption counter and checkpoints).
+
+    Each update is appended to a small journal so it survives a crash, while the
+    full bot_config.json rewrite only happens every `flush_interval` seconds, every
+    `flush_every` updates, or when flush() is called at shutdown/cancel.
+    """
+    def __init__(self, flush_interval=5.0, flush_every=50):
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._config = None
+        self._pending = 0
+        self._timer = None
+
+    def configure(self, config):
+        self.flush_interval = float(config.get("state_flush_interval", self.flush_interval))
+        self.flush_every = int(config.get("state_flush_every", self.flush_every))
+
+    def record(self, route):
+        """Journals the current counter and checkpoint of a Route."""
+        config = route.config
+        entry = {"route": route.index, "count": route.settings.get("count", 1), "checkpoint": [route.key, route.checkpoint()]}
+        try:
+            with open(JOURNAL_FILE, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            print(f"Error writing state journal: {e}")
+
+        self._config = config
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+        elif self._timer is None:
+            try:
+                self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+            except RuntimeError: # No event loop, write through
+                self.flush()
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending and self._config is not None:
+            save_configuration(self._config)
+        self._pending = 0
+
+
+state_writer = StateWriter()
+
+def _route_key(config, mode):
+    return f"{config['source_channel']}:{config['destination_channel']}:{mode}"
+
+def get_checkpoint(config, mode):
+    """Returns the last source message ID handled for the configured route, or 0."""
+    return config.get("checkpoints", {}).get(_route_key(config, mode), 0)
+
+def reset_checkpoint(config, mode):
+    config.setdefault("checkpoints", {}).pop(_route_key(config, mode), None)
+
+def clear_checkpoints(config, mode=None):
+    """Forgets backfill progress for every route (or only routes using the given mode)."""
+    checkpoints = config.setdefault("checkpoints", {})
+    for key in list(checkpoints):
+        if mode is None or key.endswith(f":{mode}"):
+            del checkpoints[key]
+
+
+class Route:
+    """
+    One source -> destination forwarding route.
+
+    `settings` holds the route's chats, prefix and counter. For the pair configured
+    through the GUI/CLI it is the top-level config itself; for route table entries it
+    is the entry dict, and `index` is its position in config["routes"]. Options a
+    route entry does not set fall back to the top-level config. The configured pair
+    and route table entries for the same chats share one caption counter (see
+    counters()), as they share checkpoints.
+    """
+    shares_counter = True # False for routes that number on their own (archive imports)
+
+    def __init__(self, config, settings, mode, index=None):
+        self.config = config
+        self.settings = settings
+        self.mode = mode
+        self.index = index
+        self.forwarded = 0
+        self.skipped = 0
+        self.repeated = 0 # Media skipped because the same file was already posted (media_dedup)
+        self.backfilling = False # While True, live message IDs are handed to the backfill to skip
+        self.backfill_done = False # Set once the backfill reached its boundary; only then does the live path move the checkpoint
+        self.live_ids = set() # Live message IDs handed to the live path while the backfill runs
+
+    @property
+    def source(self):
+        return self.settings["source_channel"]
+
+    @property
+    def destination(self):
+        return self.settings["destination_channel"]
+
+    @property
+    def key(self):
+        return _route_key(self.settings, self.mode)
+
+    @property
+    def label(self):
+        return f"{self.settings.get('source_name', self.source)} -> {self.settings.get('destination_name', self.destination)}"
+
+    def option(self, name, default=None):
+        if name in self.settings:
+            return self.settings[name]
+        return self.config.get(name, default)
+
+    def counters(self):
+        """
+        The dicts whose "count" this route advances: its own settings, plus the
+        configured pair and every route table entry with the same source and
+        destination, so none of them reuses a number another one posted.
+        """
+        counters = [self.settings]
+        if self.shares_counter:
+            chats = (self.source, self.destination)
+            for settings in [self.config] + list(self.config.get("routes") or []):
+                if settings is not self.settings and (settings.get("source_channel"), settings.get("destination_channel")) == chats:
+                    counters.append(settings)
+        return counters
+
+    def checkpoint(self):
+        return self.config.get("checkpoints", {}).get(self.key, 0)
+
+    def set_checkpoint(self, message_id):
+        checkpoints = self.config.setdefault("checkpoints", {})
+        if message_id > checkpoints.get(self.key, 0):
+            checkpoints[self.key] = message_id
+
+    def add_forwarded(self, count):
+        self.forwarded += count
+        metrics.inc("forwarded_total", count, route=self.key)
+
+    def add_skipped(self, count):
+        self.skipped += count
+        metrics.inc("skipped_total", count, route=self.key)
+
+    def add_repeated(self, count):
+        self.repeated += count
+        self.add_skipped(count)
+        metrics.inc("media_duplicates_total", count, route=self.key)
+
+    def add_failed(self, count):
+        metrics.inc("failed_total", count, route=self.key)
+
+
+def get_routes(config):
+    """Returns a Route for every enabled entry of the route table."""
+    return [Route(config, settings, settings.get("mode", "1"), index)
+            for index, settings in enumerate(config.get("routes") or [])
+            if settings.get("enabled", True)]
+
+def add_route(config, source_channel, destination_channel, mode, source_name=None, destination_name=None, prefix=None):
+    """
+    Adds a route table entry, or returns the existing one for the same chats and mode.
+    An entry for the top-level pair shares its checkpoint and caption counter
+    (see Route.counters), and starts with the pair's prefix.
+    """
+    for settings in config.setdefault("routes", []):
+        if (settings["source_channel"], settings["destination_channel"], settings.get("mode", "1")) == (source_channel, destination_channel, mode):
+            return settings
+    count = 1
+    if (config.get("source_channel"), config.get("destination_channel")) == (source_channel, destination_channel):
+        count = config.get("count", 1)
+        prefix = config.get("prefix") or prefix
+    settings = {
+        "source_channel": source_channel,
+        "destination_channel": destination_channel,
+        "source_name": source_name or str(source_channel),
+        "destination_name": destination_name or str(destination_channel),
+        "mode": mode,
+        "prefix": prefix or config.get("prefix", "Caption"),
+        "count": count
+    }
+    config["routes"].append(settings)
+    return settings
+
 async def initialize_telegram_client(api_id, api_hash, on_phone_request, on_code_request, on_password_request):
     global client
-    client = TelegramClient(SESSION_FILE, api_id, api_hash)
+    # FloodWaits are raised instead of slept through inside the request, so the rate
+    # limiter sees every one of them (and slows the bucket) rather than only those over 60s.
+    # Requests outside the limiter wait them out through _call_waiting/_flood_sleep.
+    client = TelegramClient(SESSION_FILE, api_id, api_hash, flood_sleep_threshold=0)
     await client.connect()
 
     if not await client.is_user_authorized():
         phone_number = await on_phone_request()
-        await client.send_code_request(phone_number)
+        await _call_waiting(functools.partial(client.send_code_request, phone_number), "login")
         try:
             code = await on_code_request()
-            await client.sign_in(phone_number, code)
+            await _call_waiting(functools.partial(client.sign_in, phone_number, code), "login")
         except SessionPasswordNeededError:
             password = await on_password_request()
-            await client.sign_in(password=password)
+            await _call_waiting(functools.partial(client.sign_in, password=password), "login")
     
     return client
 
-async def get_chats():
+def get_dialog_directory():
+    """The persisted dialog directory, loaded from disk on first use."""
+    global dialog_directory
+    if dialog_directory is None:
+        dialog_directory = DialogDirectory(DIALOG_CACHE_FILE)
+    return dialog_directory
+
+def get_cached_chats():
+    """Returns the cached chat list instantly, without touching the network."""
+    return get_dialog_directory().chats()
+
+async def get_chats(force_refresh=False):
+    """
+    Refreshes the dialog directory and returns its chats, most recently active first.
+    Only dialogs with activity since the last refresh are fetched, unless the cache
+    is empty or force_refresh is set.
+    """
     if not client or not client.is_connected():
         raise ConnectionError("Client is not connected.")
-    
-    chats = []
-    async for dialog in client.iter_dialogs():
-        chat_type = "Channel" if dialog.is_channel else "Group" if dialog.is_group else "User"
-        chats.append({"id": dialog.id, "name": dialog.name, "type": chat_type})
-    return chats
 
+    directory = get_dialog_directory()
+    full = force_refresh or not len(directory)
+    since = 0 if full else directory.synced_date
+    chats = {} # Chat ID -> entry; a read resumed after a FloodWait may repeat a few dialogs
+    offset = {}
+    last = None # Last non-pinned dialog read, where a read cut off by a FloodWait resumes
+    attempt = 0
+    while True:
+        try:
+            async for dialog in client.iter_dialogs(**offset):
+                date = dialog.date.timestamp() if dialog.date else 0
+                if not full and not dialog.pinned and date <= since:
+                    break # Dialogs come newest first: the rest of the list has not changed
+                chat_type = "Channel" if dialog.is_channel else "Group" if dialog.is_group else "User"
+                chats[dialog.id] = {"id": dialog.id, "name": dialog.name, "type": chat_type, "date": date}
+                if not dialog.pinned:
+                    last = dialog
+            break
+        except (FloodWaitError, FloodPremiumWaitError) as e:
+            attempt += 1
+            await _flood_sleep(e, attempt, "dialogs")
+            if last is not None:
+                offset = {"offset_date": last.date, "offset_id": last.message.id if last.message else 0,
+                          "offset_peer": last.input_entity}
+    directory.update(list(chats.values()), full=full)
+    try:
+        directory.save()
+    except Exception as e:
+        print(f"Error saving dialog cache: {e}")
+    return directory.chats()
 
-async def start_forwarding(config, mode, status_callback):
-    if not client:
-        raise ConnectionError("Client not initialized.")
 
-    forwarded_count = 0
-    skipped_count = 0
+# === Entity cache ===
+def _peer_to_dict(peer):
+    if isinstance(peer, InputPeerChannel):
+        return {"type": "channel", "id": peer.channel_id, "access_hash": peer.access_hash}
+    if isinstance(peer, InputPeerUser):
+        return {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+    if isinstance(peer, InputPeerChat):
+        return {"type": "chat", "id": peer.chat_id}
+    return None # Self and other special peers are cheap to resolve and not worth persisting
+
+def _peer_from_dict(data):
+    if data["type"] == "channel":
+        return InputPeerChannel(data["id"], data["access_hash"])
+    if data["type"] == "user":
+        return InputPeerUser(data["id"], data["access_hash"])
+    return InputPeerChat(data["id"])
+
+def input_peer(chat_id):
+    """The resolved InputPeer of a chat, or the bare ID if it was never resolved."""
+    return entity_cache.get(chat_id, chat_id)
+
+async def resolve_entities(config, chat_ids, status_callback=None):
+    """
+    Resolves every chat once, before any message is sent, and keeps the InputPeers in
+    memory and in config["entities"]. Chats missing from the session are looked up
+    through a full dialog refresh; a chat that still cannot be found raises ValueError
+    here instead of failing part-way through a backfill.
+    """
+    persisted = config.setdefault("entities", {})
+    changed = False
+    for chat_id in chat_ids:
+        if chat_id in entity_cache:
+            continue
+        if str(chat_id) in persisted:
+            entity_cache[chat_id] = _peer_from_dict(persisted[str(chat_id)])
+            continue
+        try:
+            peer = await _call_waiting(functools.partial(client.get_input_entity, chat_id), "resolve", status_callback)
+        except ValueError:
+            if status_callback:
+                status_callback(f"Chat {chat_id} is not in the session yet. Reloading the chat list...")
+            await get_chats(force_refresh=True) # Walking the dialogs stores their entities in the session
+            try:
+                peer = await _call_waiting(functools.partial(client.get_input_entity, chat_id), "resolve", status_callback)
+            except ValueError:
+                raise ValueError(f"Could not find chat {chat_id}. Make sure this account is a member of it.")
+        entity_cache[chat_id] = peer
+        data = _peer_to_dict(peer)
+        if data is not None:
+            persisted[str(chat_id)] = data
+            changed = True
+    if changed:
+        save_configuration(config)
+
+def clear_entities(config=None):
+    entity_cache.clear()
+    if config is not None:
+        config["entities"] = {}
+
 
-    status_callback("Starting backfill of old messages...")
+def _media_filters(kinds):
+    kinds = set(kinds or MEDIA_FILTERS)
+    unknown = kinds - set(MEDIA_FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown media kinds: {', '.join(sorted(unknown))}")
+    filters = []
+    if {"photo", "video"} <= kinds: # One combined search instead of two
+        filters.append(InputMessagesFilterPhotoVideo)
+        kinds -= {"photo", "video"}
+    filters.extend(MEDIA_FILTERS[kind] for kind in sorted(kinds))
+    return filters
 
+def media_kind(message):
+    """The MEDIA_FILTERS kind of a message's media, or None for text, stickers and other media."""
+    if message.photo:
+        return "photo"
+    if message.gif:
+        return "gif"
+    if message.video_note:
+        return "round"
+    if message.video:
+        return "video"
+    if message.voice:
+        return "voice"
+    if message.audio:
+        return "audio"
+    if message.document and not message.sticker:
+        return "document"
+    return None
+
+def is_wanted_media(message, kinds=None):
+    """Local equivalent of the search filters, used for live messages."""
+    kind = media_kind(message)
+    return kind is not None and kind in set(kinds or MEDIA_FILTERS)
+
+async def _next_or_none(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def _merge_ascending(iterators):
+    """Merges async iterators of messages that are each sorted by ID, dropping duplicate IDs."""
+    heap = []
+    for index, iterator in enumerate(iterators):
+        message = await _next_or_none(iterator)
+        if message is not None:
+            heapq.heappush(heap, (message.id, index, message))
+    last_id = None
+    while heap:
+        message_id, index, message = heapq.heappop(heap)
+        if message_id != last_id:
+            last_id = message_id
+            yield message
+        following = await _next_or_none(iterators[index])
+        if following is not None:
+            heapq.heappush(heap, (following.id, index, following))
+
+async def _iter_pages(chat_id, low, high=0, filter=None, status_callback=None):
+    """
+    Pages of the messages with low < ID < high (no upper bound if high is 0) in
+    ascending order, one rate-limited request per page and no other pause.
+    """
+    cursor = low
+    while True:
+        page = await rate_limiter.call(chat_id, "history", functools.partial(
+            client.get_messages, input_peer(chat_id), limit=HISTORY_PAGE_SIZE, reverse=True,
+            min_id=cursor, max_id=high, filter=filter), status_callback)
+        # Only an empty page ends the range. Telegram may return short pages before
+        # the end (it leaves out e.g. messages hidden by local laws).
+        if not page:
+            return
+        yield page
+        cursor = page[-1].id
+        if high and cursor >= high - 1:
+            return
+
+async def _fetch_range(chat_id, low, high, filter=None, status_callback=None):
+    """Messages with low < ID < high in ascending order, as one list."""
+    return [message async for page in _iter_pages(chat_id, low, high, filter, status_callback) for message in page]
+
+async def iter_history(chat_id, min_id=0, max_id=0, filter=None, workers=1, range_size=1000, status_callback=None):
+    """
+    Iterates over the messages of a chat with min_id < ID < max_id in ascending order.
+
+    With several workers, the ID space of a channel is split into ranges of
+    `range_size` IDs that are fetched concurrently and handed out strictly in order.
+    Every page request goes through the "history" rate limit, and at most
+    workers + 1 ranges are held in memory. Otherwise the chat is read with one
+    cursor: always for filtered searches, which would pay at least one request per
+    range however few messages match, and for chats whose IDs are not per chat
+    (users and basic groups).
+    """
+    if workers <= 1 or filter is not None or not _is_channel_id(chat_id):
+        async for page in _iter_pages(chat_id, min_id, max_id, filter, status_callback):
+            for message in page:
+                yield message
+        return
+    if not max_id:
+        latest = await rate_limiter.call(chat_id, "history", functools.partial(
+            client.get_messages, input_peer(chat_id), limit=1), status_callback)
+        if not latest:
+            return
+        max_id = latest[0].id + 1
+    range_size = max(HISTORY_PAGE_SIZE, int(range_size))
+    count = max(0, (max_id - 1 - min_id + range_size - 1) // range_size)
+    ranges = iter(range(count))
+    results = {} # Range number -> future of its messages
+    slots = asyncio.Semaphore(workers + 1) # Ranges taken but not yet handed out
+    loop = asyncio.get_running_loop()
+
+    async def fetch():
+        while True:
+            await slots.acquire()
+            number = next(ranges, None)
+            if number is None:
+                return
+            low = min_id + number * range_size
+            future = results.setdefault(number, loop.create_future())
+            try:
+                future.set_result(await _fetch_range(chat_id, low, min(low + range_size + 1, max_id), filter, status_callback))
+            except Exception as e:
+                future.set_exception(e)
+                return
+
+    tasks = [asyncio.ensure_future(fetch()) for _ in range(min(workers, count))]
+    try:
+        for number in range(count):
+            messages = await results.setdefault(number, loop.create_future())
+            del results[number]
+            slots.release()
+            for message in messages:
+                yield message
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def iter_media_history(chat_id, kinds=None, min_id=0, max_id=0, workers=1, range_size=1000):
+    """
+    Iterates over the media messages of a chat in ascending ID order. Telegram does
+    the filtering, so text-only messages are never downloaded, and each filter is
+    read with a single cursor (see iter_history).
+    """
+    iterators = [iter_history(chat_id, min_id, max_id, f, workers, range_size) for f in _media_filters(kinds)]
+    if len(iterators) == 1:
+        return iterators[0]
+    return _merge_ascending(iterators)
+
+
+class _OrderedGate:
+    """Lets concurrent pipeline workers complete their units strictly in sequence order."""
+    def __init__(self):
+        self.next_seq = 0
+        self._condition = asyncio.Condition()
+
+    async def wait_turn(self, seq):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.next_seq == seq)
+
+    async def advance(self):
+        async with self._condition:
+            self.next_seq += 1
+            self._condition.notify_all()
+
+async def run_pipeline(units, send, prepare=None, queue_size=10, workers=1, name=None):
+    """
+    Drains the async iterator `units` into a bounded queue from a producer task while
+    `workers` tasks take units off the queue, run the optional prepare(unit) step
+    concurrently and then call send(prepared_unit) strictly in production order.
+
+    Fetching and sending overlap, and at most queue_size + workers units are held in
+    memory however long the history is. With a `name`, the queue depth is
+    reported as a metric.
+    """
+    queue = asyncio.Queue(maxsize=max(1, queue_size))
+    if name is not None:
+        metrics.track_queue("queue_depth", queue, stage="prefetch", route=name)
+    gate = _OrderedGate()
+    workers = max(1, workers)
+    done = object()
+
+    async def produce():
+        seq = 0
+        async for unit in units:
+            await queue.put((seq, unit))
+            seq += 1
+        for _ in range(workers):
+            await queue.put((None, done))
+
+    async def work():
+        while True:
+            seq, unit = await queue.get()
+            if unit is done:
+                return
+            prepared = await prepare(unit) if prepare else unit
+            await gate.wait_turn(seq)
+            try:
+                await send(prepared)
+            finally:
+                await gate.advance()
+
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(work()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if name is not None:
+            metrics.untrack_queue("queue_depth", stage="prefetch", route=name)
+
+
+async def start_metrics(config, status_callback=None):
+    """Turns metrics collection on or off from config and starts the HTTP endpoint if a port is set."""
+    metrics.enabled = bool(config.get("metrics_enabled"))
+    port = config.get("metrics_port")
+    if not metrics.enabled or not port:
+        return
+    host = config.get("metrics_host") or "127.0.0.1"
+    try:
+        await metrics.serve(host, int(port))
+    except OSError as e:
+        if status_callback:
+            status_callback(f"Could not start the metrics endpoint on {host}:{port}: {e}")
+
+def get_metrics():
+    """Snapshot of all counters, queue depths and latency histograms (empty while metrics are disabled)."""
+    return metrics.snapshot()
+
+def open_message_index(config):
+    global message_index
+    if message_index is None:
+        message_index = MessageIndex(config.get("message_index_file") or INDEX_FILE)
+    return message_index
+
+def close_message_index():
+    global message_index
+    if message_index is not None:
+        message_index.close()
+        message_index = None
+
+def forget_forwarded(config):
+    """
+    Forgets which messages the configured pair already forwarded, so a backfill that
+    is started over posts them again instead of skipping them as duplicates.
+    """
+    if config.get("source_channel") is None or config.get("destination_channel") is None:
+        return
+    open_message_index(config).forget(config["source_channel"], config["destination_channel"])
+
+def flush_state():
+    """Writes buffered counters, checkpoints and index rows to disk."""
+    state_writer.flush()
+    if message_index is not None:
+        message_index.commit()
+    if media_dedup is not None:
+        media_dedup.commit()
+
+def _already_forwarded(route, messages):
+    """Returns the IDs among messages that the index says already reached the route's destination."""
+    if not route.option("duplicate_check", True) or not messages:
+        return set()
+    index = open_message_index(route.config)
+    return index.forwarded_ids(route.source, [m.id for m in messages], route.destination)
+
+def open_media_dedup(config):
+    global media_dedup
+    if media_dedup is None:
+        media_dedup = MediaDedupIndex(config.get("media_dedup_file") or MEDIA_DEDUP_FILE,
+                                      config.get("media_dedup_days", 0), config.get("media_dedup_max_entries", 1000000))
+    return media_dedup
+
+def close_media_dedup():
+    global media_dedup
+    if media_dedup is not None:
+        media_dedup.close()
+        media_dedup = None
+
+def media_identities(message, match_size=False):
+    """Keys that identify the file of a media message, however often it is reposted."""
+    if isinstance(message, ArchivedMessage):
+        info = message.media_info
+        identities = [info["key"]] if info.get("key") else []
+        if info.get("sha256"):
+            identities.append(f"sha256:{info['sha256']}")
+        size, mime_type = info.get("size"), info.get("mime_type")
+    else:
+        identities = [_media_key(message)]
+        size, mime_type = (message.file.size, message.file.mime_type) if message.file else (None, None)
+    if match_size and size:
+        identities.append(f"size:{size}:{mime_type}")
+    return identities
+
+def _drop_repeated_media(route, messages):
+    """Returns the messages whose file was not posted to the route's destination yet (media_dedup)."""
+    if not route.option("media_dedup"):
+        return messages
+    index = open_media_dedup(route.config)
+    match_size = route.option("media_dedup_match_size", False)
+    remaining = [m for m in messages if not index.is_posted(route.destination, media_identities(m, match_size))]
+    if len(remaining) < len(messages):
+        route.add_repeated(len(messages) - len(remaining))
+    return remaining
+
+def _record_posted_media(route, messages):
+    if not route.option("media_dedup"):
+        return
+    index = open_media_dedup(route.config)
+    match_size = route.option("media_dedup_match_size", False)
+    for message in messages:
+        index.add(route.destination, media_identities(message, match_size))
+
+def _observe_latency(messages, priority):
+    """Source post -> destination post latency, split into the live and backfill paths."""
+    if not metrics.enabled:
+        return
+    now = time.time()
+    path = "live" if priority == PRIORITY_LIVE else "backfill"
+    for message in messages:
+        if message.date is not None:
+            metrics.observe("latency_seconds", now - message.date.timestamp(), path=path)
+
+def _record_forwarded(route, source_message, destination_message, caption_number=None):
+    if destination_message is None:
+        return
+    open_message_index(route.config).add(route.source, source_message.id, route.destination,
+                                         destination_message.id, caption_number)
+
+
+async def _forward_batch(route, batch, status_callback, priority=PRIORITY_BACKFILL):
+    """
+    Forwards a run of consecutive source messages with a single request.
+    If the batch request fails, only that batch is retried message by message.
+    Returns the number of messages that were forwarded.
+    """
+    destination = route.destination
+    try:
+        sent = await rate_limiter.call(destination, "forward", functools.partial(
+            client.forward_messages, input_peer(destination), [m.id for m in batch], input_peer(route.source)), status_callback, priority)
+        for message, sent_message in zip(batch, sent):
+            _record_forwarded(route, message, sent_message)
+        _observe_latency(batch, priority)
+        return len(batch)
+    except Exception as e:
+        status_callback(f"ERROR forwarding batch {batch[0].id}-{batch[-1].id}: {e}. Retrying one by one...")
+
+    forwarded = 0
+    for message in batch:
+        try:
+            sent_message = await rate_limiter.call(destination, "forward", functools.partial(
+                client.forward_messages, input_peer(destination), message), status_callback, priority)
+            _record_forwarded(route, message, sent_message)
+            _observe_latency([message], priority)
+            forwarded += 1
+        except Exception as e:
+            route.add_failed(1)
+            status_callback(f"ERROR forwarding message ID {message.id}: {e}")
+    return forwarded
+
+
+async def _send_files(route, files, caption, status_callback, priority):
+    """Sends one file or one album to the route's destination. Always returns a list of messages."""
+    destination = route.destination
+    sent = await rate_limiter.call(destination, "send", functools.partial(
+        client.send_file, input_peer(destination), file=files if len(files) > 1 else files[0], caption=caption), status_callback, priority)
+    return sent if isinstance(sent, list) else [sent]
+
+async def _send_with_caption(route, messages, status_callback, priority=PRIORITY_BACKFILL):
+    """
+    Re-posts the media of one message or one album with the route's next custom
+    caption number(s) and advances its counter. Returns the caption text for status.
+    Media from a chat that forbids forwarding is re-uploaded through the media cache.
+
+    Live and backfill sends of a route run concurrently, so the number is reserved
+    (the counter advanced) before the first await: a live send that overtakes this
+    one while it waits for a token, a FloodWait or a re-upload takes the next number,
+    and no number is posted twice. A failed send gives its number back if none was
+    taken after it, and otherwise leaves a reported gap.
+    """
+    counters = route.counters()
+    number = max(counter.get("count", 1) for counter in counters)
+    prefix = route.settings["prefix"]
+    if len(messages) == 1:
+        numbers = [number]
+        caption = f"{prefix} {number}"
+    elif route.option("album_numbering", "album") == "each":
+        numbers = list(range(number, number + len(messages)))
+        caption = [f"{prefix} {n}" for n in numbers]
+    else: # One number for the whole album, shown under its first item
+        numbers = [number] * len(messages)
+        caption = f"{prefix} {number}"
+    for counter in counters:
+        counter["count"] = numbers[-1] + 1
     try:
-        async for message in client.iter_messages(config["source_channel"], reverse=True):
-            if mode == '1': # Original Caption
+        sent = await _send_media(route, messages, caption, status_callback, priority)
+    except BaseException:
+        if all(counter["count"] == numbers[-1] + 1 for counter in counters):
+            for counter in counters:
+                counter["count"] = number
+        else:
+            status_callback(f"Caption {prefix} {numbers[0]}" + (f"-{numbers[-1]}" if numbers[-1] != numbers[0] else "")
+                            + " was not posted; later numbers were already taken, so it is left as a gap.")
+        raise
+    for message, sent_message, n in zip(messages, sent, numbers):
+        _record_forwarded(route, message, sent_message, n)
+    _record_posted_media(route, messages)
+    _observe_latency(messages, priority)
+    if priority == PRIORITY_BACKFILL or route.backfill_done:
+        route.set_checkpoint(messages[-1].id) # Journaled together with the counter, so a restart never reuses a number
+    state_writer.record(route)
+    if numbers[0] == numbers[-1]:
+        return f"{prefix} {numbers[0]}"
+    return f"{prefix} {numbers[0]}-{numbers[-1]}"
+
+async def _send_media(route, messages, caption, status_callback, priority):
+    """Sends the media of messages with caption, re-uploading it if the source forbids forwarding."""
+    # Archive media was already uploaded by import_archive; only live source media can be restricted
+    reupload = route.option("reupload_protected", True) and not isinstance(messages[0], ArchivedMessage)
+    sent = None
+    if not reupload or (route.source not in protected_sources and not any(getattr(m, "noforwards", False) for m in messages)):
+        try:
+            sent = await _send_files(route, [m.media for m in messages], caption, status_callback, priority)
+        except ChatForwardsRestrictedError:
+            if not reupload:
+                raise
+            protected_sources.add(route.source)
+            status_callback("The source chat does not allow forwarding. Its media is downloaded and uploaded again from now on.")
+    if sent is None:
+        sent = await _send_reuploaded(route, messages, caption, status_callback, priority)
+    return sent
+
+
+async def group_albums(messages):
+    """Groups consecutive messages sharing a grouped_id into lists; other messages come as one-item lists."""
+    album = []
+    async for message in messages:
+        if album and message.grouped_id is not None and message.grouped_id == album[-1].grouped_id:
+            album.append(message)
+            continue
+        if album:
+            yield album
+        album = [message]
+    if album:
+        yield album
+
+
+def _is_channel_id(chat_id):
+    return chat_id <= -1000000000000 # Telethon marks channel IDs as -100xxxxxxxxxx
+
+
+class SyncPropagator:
+    """
+    Mirrors edits and deletions of already forwarded source messages onto their copies,
+    using the message index to find them.
+
+    Edits are debounced per message, so a burst of edits costs one request with the
+    final version. Deleted IDs are buffered per destination and removed in chunks of
+    up to 100 IDs, like clear_chat does.
+    """
+    def __init__(self, config, routes, status_callback):
+        self.config = config
+        self.status_callback = status_callback
+        self.edit_delay = float(config.get("edit_debounce_seconds", 1.0))
+        self.delete_delay = float(config.get("delete_coalesce_seconds", 1.0))
+        self._routes = {(route.source, route.destination): route for route in routes}
+        self._sources = {route.source for route in routes}
+        self._edits = {} # (source chat, source message ID) -> [latest message, deadline]
+        self._edit_tasks = {}
+        self._deletions = {} # destination chat -> [destination message ID, ...]
+        self._delete_task = None
+
+    # === Edits ===
+    def on_edit(self, source_chat, message):
+        key = (source_chat, message.id)
+        self._edits[key] = [message, time.monotonic() + self.edit_delay]
+        if key not in self._edit_tasks:
+            self._edit_tasks[key] = asyncio.ensure_future(self._edit_after_quiet(key))
+
+    async def _edit_after_quiet(self, key):
+        try:
+            while True:
+                delay = self._edits[key][1] - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            message, _ = self._edits.pop(key)
+            await self._apply_edit(key[0], message)
+        finally:
+            self._edit_tasks.pop(key, None)
+
+    async def _apply_edit(self, source_chat, message):
+        if not message.media:
+            return
+        for destination, destination_id, caption_number in open_message_index(self.config).lookup(source_chat, message.id):
+            route = self._routes.get((source_chat, destination))
+            # Forwarded copies cannot be edited; only re-captioned copies can follow the source
+            if route is None or route.mode != '2' or not route.option("sync_edits") or caption_number is None:
+                continue
+            caption = f"{route.settings['prefix']} {caption_number}"
+            try:
+                await rate_limiter.call(destination, "send", functools.partial(
+                    client.edit_message, input_peer(destination), destination_id, text=caption, file=message.media), self.status_callback, PRIORITY_LIVE)
+                self.status_callback(f"Updated copy of edited message ID {message.id} ('{caption}').")
+            except Exception as e:
+                self.status_callback(f"ERROR updating copy of edited message ID {message.id}: {e}")
+
+    # === Deletions ===
+    def on_delete(self, source_chat, source_ids):
+        if source_chat is None:
+            # Deletions outside channels do not say which chat they came from, but their IDs are unique per account
+            candidates = [chat for chat in self._sources if not _is_channel_id(chat)]
+        else:
+            candidates = [source_chat] if source_chat in self._sources else []
+        index = open_message_index(self.config)
+        queued = False
+        for chat in candidates:
+            for source_id, destination, destination_id, _ in index.lookup_many(chat, source_ids):
+                route = self._routes.get((chat, destination))
+                if route is None or not route.option("sync_deletions"):
+                    continue
+                index.remove(chat, [source_id], destination)
+                if destination_id is not None:
+                    self._deletions.setdefault(destination, []).append(destination_id)
+                    queued = True
+        if not queued:
+            return
+        if any(len(ids) >= MAX_FORWARD_BATCH for ids in self._deletions.values()):
+            asyncio.ensure_future(self.flush_deletions())
+        elif self._delete_task is None:
+            self._delete_task = asyncio.ensure_future(self._delete_after_delay())
+
+    async def _delete_after_delay(self):
+        try:
+            await asyncio.sleep(self.delete_delay)
+        finally:
+            self._delete_task = None
+        await self.flush_deletions()
+
+    async def flush_deletions(self):
+        pending, self._deletions = self._deletions, {}
+        for destination, ids in pending.items():
+            for i in range(0, len(ids), 100):
+                chunk = ids[i:i+100]
                 try:
-                    await client.forward_messages(config["destination_channel"], message)
-                    forwarded_count += 1
-                    status_callback(f"Forwarded message ID {message.id}. Total: {forwarded_count}")
+                    await rate_limiter.call(destination, "delete", functools.partial(
+                        client.delete_messages, input_peer(destination), chunk, revoke=True), self.status_callback, PRIORITY_LIVE)
+                    self.status_callback(f"Deleted {len(chunk)} copies of messages removed from the source.")
                 except Exception as e:
-                    status_callback(f"ERROR forwarding message ID {message.id}: {e}")
-            elif mode == '2' and message.media: # Custom Caption
-                caption = f"{config['prefix']} {config['count']}"
-                await client.send_file(config["destination_channel"], file=message.media, caption=caption)
-                config["count"] += 1
-                forwarded_count += 1
-                status_callback(f"Forwarded media with caption '{caption}'. Total: {forwarded_count}")
-                save_configuration(config)
+                    self.status_callback(f"ERROR deleting copies of removed messages: {e}")
+
+    async def close(self):
+        """Applies pending edits and deletions immediately."""
+        for task in list(self._edit_tasks.values()):
+            task.cancel()
+        pending, self._edits = self._edits, {}
+        for (source_chat, _), (message, _) in pending.items():
+            await self._apply_edit(source_chat, message)
+        if self._delete_task is not None:
+            self._delete_task.cancel()
+        await self.flush_deletions()
+
+
+class _FanoutFeed:
+    """
+    One destination's share of a history read that feeds several routes.
+
+    The shared reader waits up to `stall_seconds` for room in the feed's queue. A
+    destination that stays full for longer (typically one held up by a long
+    FloodWait) is detached so it no longer slows the others down; once it has sent
+    everything it was given, it catches up with its own read from where it stopped.
+    """
+    def __init__(self, engine, route, queue_size, stall_seconds):
+        self.engine = engine
+        self.route = route
+        self.queue = asyncio.Queue(maxsize=max(1, queue_size))
+        metrics.track_queue("queue_depth", self.queue, stage="fanout", route=route.key)
+        self.stall_seconds = stall_seconds
+        self.last_id = route.checkpoint()
+        self.detached = False
+        self.failed = False
+
+    async def offer(self, message):
+        if self.detached or message.id <= self.last_id:
+            return
+        try:
+            await asyncio.wait_for(self.queue.put(message), self.stall_seconds)
+            self.last_id = message.id
+        except asyncio.TimeoutError:
+            self.detached = True
+            self.engine._status(self.route, f"Destination is falling behind; it will catch up on its own after message ID {self.last_id}.")
+
+    async def close(self):
+        await self.queue.put(None)
+
+    async def messages(self):
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                break
+            yield message
+        metrics.untrack_queue("queue_depth", stage="fanout", route=self.route.key)
+        if self.detached:
+            async for message in self.engine._history([self.route], self.last_id):
+                yield message
+
+
+class ForwardingEngine:
+    """
+    Serves any number of routes from the one shared client.
+
+    Live forwarding starts right away: a single NewMessage handler looks up the
+    routes of the message's chat in a dict and queues the message per route.
+    At the same time, backfill reads each source chat once (up to the newest
+    message at start) and fans the messages out to every route of that source;
+    each destination then batches, numbers and sends on its own pipeline.
+    All sends go through the shared rate limiter, which keeps a budget per
+    destination and always serves live messages before backfill, so backfill only
+    uses the budget live traffic leaves over.
+    """
+    def __init__(self, config, routes, status_callback):
+        self.config = config
+        self.routes = routes
+        self.status_callback = status_callback
+        self.by_source = {} # source chat ID -> [Route, ...]
+        for route in routes:
+            self.by_source.setdefault(route.source, []).append(route)
+        self.propagator = None
+        self._live_queues = {} # Route -> queue of live messages (lists: one message or one album)
+        self._workers = []
+        self._albums = {} # source chat ID -> album parts collected so far
+        self.album_window = float(config.get("album_window_seconds", 1.0))
+        self._boundaries = {} # source chat ID -> newest message ID when the backfill started
+        self._handlers = [] # (callback, event) pairs registered on the client by this engine
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+    @property
+    def paused(self):
+        return not self._resumed.is_set()
+
+    def pause(self):
+        """Holds back all sends; live messages keep queueing and go out on resume()."""
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def _status(self, route, text):
+        if len(self.routes) > 1:
+            text = f"[{route.label}] {text}"
+        self.status_callback(text)
+
+    def progress(self):
+        """Per-route counters and backfill position, cheap enough to poll from the GUI."""
+        return [{
+            "route": route.label,
+            "forwarded": route.forwarded,
+            "skipped": route.skipped,
+            "repeated": route.repeated,
+            "backfilling": route.backfilling,
+            "position": route.checkpoint(), # Last source message ID handled
+            "target": self._boundaries.get(route.source, 0) # Newest message ID the backfill goes up to
+        } for route in self.routes]
+
+    async def run(self):
+        global current_engine
+        rate_limiter.configure(self.config.get("rate_limits"), self.config.get("flood_wait_retries"))
+        state_writer.configure(self.config)
+        await start_metrics(self.config, self.status_callback)
+        chats = set(self.by_source) | {route.destination for route in self.routes}
+        await resolve_entities(self.config, sorted(chats), self.status_callback)
+
+        limit = asyncio.Semaphore(max(1, int(self.config.get("max_parallel_backfills") or 1)))
+        async def limited_backfill(source, routes):
+            async with limit:
+                await self.backfill_source(source, routes)
+
+        current_engine = self
+        try:
+            # Live messages are forwarded from now on, with priority over the backfill
+            self.register_handlers()
+            self.status_callback("Listening for new messages. Backfilling old messages in the background...")
+            try:
+                await asyncio.gather(*(limited_backfill(source, routes) for source, routes in self.by_source.items()))
+            finally:
+                flush_state()
+
+            forwarded = sum(route.forwarded for route in self.routes)
+            skipped = sum(route.skipped for route in self.routes)
+            failed = [route for route in self.routes if not route.backfill_done]
+            if failed:
+                self.status_callback(f"Backfill FAILED for {len(failed)} of {len(self.routes)} route(s); they resume from their "
+                                     f"checkpoint on the next run. Forwarded: {forwarded}, skipped: {skipped}. Listening for new messages...")
             else:
-                skipped_count += 1
-                status_callback(f"Skipped text-only message ID {message.id}. Total skipped: {skipped_count}")
-            
-            await asyncio.sleep(1) # Rate limiting
-    except asyncio.CancelledError:
-        status_callback("Backfill cancelled.")
-        raise # Re-raise CancelledError to propagate it up
-    except Exception as e:
-        status_callback(f"Error during backfill: {e}")
+                self.status_callback(f"Backfill complete. Forwarded: {forwarded}, skipped: {skipped}. Listening for new messages...")
+
+            # Keep listening until this run is cancelled or the client disconnects
+            await client.disconnected
+        except asyncio.CancelledError:
+            self.status_callback("Forwarding cancelled.")
+            raise # Re-raise CancelledError to propagate it up
+        finally:
+            if current_engine is self:
+                current_engine = None
+            # Only this run's handlers go away; the client stays connected for the next run
+            for callback, event in self._handlers:
+                client.remove_event_handler(callback, event)
+            self._handlers = []
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            for route in self._live_queues:
+                metrics.untrack_queue("queue_depth", stage="live", route=route.key)
+            if self.propagator is not None and client.is_connected():
+                await self.propagator.close()
+            flush_state()
+
+    # === Backfill ===
+    def _history(self, routes, min_id):
+        """
+        Source history after min_id and up to the backfill boundary, filtered
+        server-side when every route only wants media.
+        """
+        source = routes[0].source
+        max_id = self._boundaries.get(source, 0) + 1
+        workers = int(self.config.get("history_workers") or 1)
+        range_size = int(self.config.get("history_range_size") or 1000)
+        if all(route.mode == '2' for route in routes):
+            kinds = set()
+            for route in routes:
+                kinds.update(route.option("media_kinds") or MEDIA_FILTERS)
+            return iter_media_history(source, kinds, min_id=min_id, max_id=max_id, workers=workers, range_size=range_size)
+        return iter_history(source, min_id, max_id, workers=workers, range_size=range_size, status_callback=self.status_callback)
+
+    async def backfill_source(self, source, routes):
+        # Everything up to the newest message right now is backfill; anything newer arrives live.
+        # The live handler is already registered, so nothing falls between the two.
+        latest = await rate_limiter.call(source, "history", functools.partial(
+            client.get_messages, input_peer(source), limit=1), self.status_callback)
+        self._boundaries[source] = latest[0].id if latest else 0
+        for route in routes:
+            route.backfilling = True
+        try:
+            if len(routes) == 1:
+                completed = await self.backfill(routes[0], self._history(routes, routes[0].checkpoint()))
+                self._finish_backfill(routes[0], completed)
+                return
+            await self._fanout_backfill(source, routes)
+        finally:
+            for route in routes:
+                route.backfilling = False
+                route.live_ids.clear()
 
-    status_callback("Backfill complete. Listening for new messages...")
+    def _finish_backfill(self, route, completed):
+        if not completed:
+            return # The checkpoint stays where the backfill stopped, so the next run resumes there
+        # The backfill covered everything up to the boundary and the live path everything after it
+        route.backfill_done = True
+        route.set_checkpoint(max([self._boundaries.get(route.source, 0)] + list(route.live_ids)))
+        state_writer.record(route)
 
-    @client.on(events.NewMessage(chats=config["source_channel"]))
-    async def new_message_handler(event):
-        nonlocal forwarded_count, skipped_count
-        if mode == '1':
+    async def _fanout_backfill(self, source, routes):
+        # Fan-out: one read of the source feeds every destination
+        feeds = [_FanoutFeed(self, route, int(self.config.get("fanout_queue_size") or 1000),
+                             float(self.config.get("fanout_stall_seconds") or 30)) for route in routes]
+
+        async def read():
             try:
-                await client.forward_messages(config["destination_channel"], event.message)
-                forwarded_count += 1
-                status_callback(f"Forwarded new message ID {event.message.id}. Total: {forwarded_count}")
+                async for message in self._history(routes, min(feed.last_id for feed in feeds)):
+                    for feed in feeds:
+                        await feed.offer(message)
+                    if all(feed.detached for feed in feeds):
+                        break
             except Exception as e:
-                status_callback(f"ERROR forwarding new message ID {event.message.id}: {e}")
-        elif mode == '2' and event.message.media:
-            caption = f"{config['prefix']} {config['count']}"
-            await client.send_file(config["destination_channel"], file=event.message.media, caption=caption)
-            config["count"] += 1
-            forwarded_count += 1
-            status_callback(f"Forwarded new media with caption '{caption}'. Total: {forwarded_count}")
-            save_configuration(config)
+                self.status_callback(f"Error reading history of chat {source}: {e}")
+                for feed in feeds:
+                    feed.failed = True
+            finally:
+                await asyncio.gather(*(feed.close() for feed in feeds))
+
+        async def send(feed):
+            completed = await self.backfill(feed.route, feed.messages())
+            self._finish_backfill(feed.route, completed and not feed.failed)
+
+        tasks = [asyncio.ensure_future(read())] + [asyncio.ensure_future(send(feed)) for feed in feeds]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def backfill(self, route, history):
+        mode = route.mode
+        batch_size = max(1, min(int(route.option("forward_batch_size") or MAX_FORWARD_BATCH), MAX_FORWARD_BATCH))
+        media_kinds = route.option("media_kinds")
+        status = functools.partial(self._status, route)
+
+        checkpoint = route.checkpoint()
+        if checkpoint:
+            status(f"Resuming backfill after message ID {checkpoint}...")
         else:
-            skipped_count += 1
-            status_callback(f"Skipped new text-only message ID {event.message.id}. Total skipped: {skipped_count}")
+            status("Starting backfill of old messages...")
 
-    # Keep the event loop running to listen for new messages
-    try:
-        await client.run_until_disconnected()
-    except asyncio.CancelledError:
-        status_callback("Forwarding listener cancelled.")
-        raise # Re-raise CancelledError to propagate it up
+        async def backfill_units():
+            # Producer side: Original Caption units are batches of consecutive messages that never split
+            # an album; Custom Caption units are single media messages or whole albums
+            batch = []
+            async for group in group_albums(history):
+                if mode == '1': # Original Caption
+                    messages = [m for m in group if not isinstance(m, MessageService)] # Service messages cannot be forwarded
+                    route.add_skipped(len(group) - len(messages))
+                    if batch and len(batch) + len(messages) > batch_size:
+                        yield batch
+                        batch = []
+                    batch.extend(messages)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                else: # Custom Caption
+                    media = [m for m in group if is_wanted_media(m, media_kinds)]
+                    route.add_skipped(len(group) - len(media))
+                    if media:
+                        yield media
+            if batch:
+                yield batch
+
+        async def send_unit(batch):
+            # Consumer side: runs strictly in source order, so counters and checkpoints stay sequential
+            await self._resumed.wait()
+            duplicates = _already_forwarded(route, batch) | {m.id for m in batch if m.id in route.live_ids}
+            if duplicates:
+                route.add_skipped(len(duplicates))
+                remaining = [m for m in batch if m.id not in duplicates]
+                if not remaining:
+                    route.set_checkpoint(batch[-1].id)
+                    return
+                batch = remaining
+            if mode == '1':
+                route.add_forwarded(await _forward_batch(route, batch, status))
+                route.set_checkpoint(batch[-1].id)
+                state_writer.record(route)
+                status(f"Forwarded batch {batch[0].id}-{batch[-1].id} ({len(batch)} messages). Total: {route.forwarded}")
+                return
+            last_id = batch[-1].id
+            batch = _drop_repeated_media(route, batch)
+            if not batch:
+                route.set_checkpoint(last_id)
+                return
+            try:
+                caption = await _send_with_caption(route, batch, status)
+                route.add_forwarded(len(batch))
+                status(f"Forwarded {'album' if len(batch) > 1 else 'media'} with caption '{caption}'. Total: {route.forwarded}")
+            except Exception as e:
+                route.add_failed(len(batch))
+                status(f"ERROR sending media from message ID {batch[0].id}: {e}")
+
+        try:
+            await run_pipeline(backfill_units(), send_unit,
+                               queue_size=int(route.option("prefetch_queue_size") or 10),
+                               workers=int(route.option("pipeline_workers") or 1), name=route.key)
+        except asyncio.CancelledError:
+            status("Backfill cancelled.")
+            raise # Re-raise CancelledError to propagate it up
+        except Exception as e:
+            status(f"Error during backfill: {e}")
+            return False
+        return True
+
+    # === Live forwarding ===
+    def register_handlers(self):
+        sources = [input_peer(source) for source in self.by_source]
+        for route in self.routes:
+            self._live_queues[route] = asyncio.Queue()
+            metrics.track_queue("queue_depth", self._live_queues[route], stage="live", route=route.key)
+            self._workers.append(asyncio.ensure_future(self._live_worker(route)))
+        self._add_handler(self.on_new_message, events.NewMessage(chats=sources))
+
+        sync_edits = any(route.option("sync_edits") for route in self.routes)
+        sync_deletions = any(route.option("sync_deletions") for route in self.routes)
+        if sync_edits or sync_deletions:
+            self.propagator = SyncPropagator(self.config, self.routes, self.status_callback)
+        if sync_edits:
+            self._add_handler(self.on_message_edited, events.MessageEdited(chats=sources))
+        if sync_deletions:
+            # No chats filter: deletions outside channels do not say which chat they came from
+            self._add_handler(self.on_message_deleted, events.MessageDeleted())
+
+    def _add_handler(self, callback, event):
+        client.add_event_handler(callback, event)
+        self._handlers.append((callback, event))
+
+    async def on_new_message(self, event):
+        chat_id, message = event.chat_id, event.message
+        if chat_id not in self.by_source:
+            return
+        pending = self._albums.get(chat_id)
+        if pending and (message.grouped_id is None or message.grouped_id != pending[0].grouped_id):
+            self._flush_album(chat_id) # A different message means the previous album is complete
+        if message.grouped_id is None:
+            self._dispatch(chat_id, [message])
+            return
+        if chat_id not in self._albums:
+            self._albums[chat_id] = []
+            asyncio.get_running_loop().call_later(self.album_window, self._flush_album, chat_id, message.grouped_id)
+        self._albums[chat_id].append(message)
+
+    def _flush_album(self, chat_id, grouped_id=None):
+        pending = self._albums.get(chat_id)
+        if not pending or (grouped_id is not None and pending[0].grouped_id != grouped_id):
+            return # Already sent, or the timer belongs to an earlier album
+        del self._albums[chat_id]
+        self._dispatch(chat_id, sorted(pending, key=lambda m: m.id))
+
+    def _dispatch(self, chat_id, messages):
+        for route in self.by_source.get(chat_id, ()):
+            self._live_queues[route].put_nowait(messages)
+
+    async def _live_worker(self, route):
+        # Each destination drains its own queue in arrival order
+        queue = self._live_queues[route]
+        while True:
+            messages = await queue.get()
+            await self._resumed.wait()
+            try:
+                await self.forward_live(route, messages)
+            except Exception as e:
+                route.add_failed(len(messages))
+                self._status(route, f"ERROR forwarding new message ID {messages[0].id}: {e}")
+
+    async def on_message_edited(self, event):
+        if event.chat_id in self.by_source:
+            self.propagator.on_edit(event.chat_id, event.message)
+
+    async def on_message_deleted(self, event):
+        self.propagator.on_delete(event.chat_id, event.deleted_ids)
+
+    async def forward_live(self, route, messages):
+        """Sends one live message or one complete album to a route, ahead of any backfill."""
+        status = functools.partial(self._status, route)
+        duplicates = _already_forwarded(route, messages)
+        if duplicates:
+            route.add_skipped(len(duplicates))
+            messages = [m for m in messages if m.id not in duplicates]
+            if not messages:
+                return
+        if route.backfilling:
+            route.live_ids.update(m.id for m in messages) # Hand-off: the backfill skips these IDs
+        first_id = messages[0].id
+        if route.mode == '1':
+            forwarded = await _forward_batch(route, messages, status, PRIORITY_LIVE)
+            if route.backfill_done:
+                route.set_checkpoint(messages[-1].id)
+            state_writer.record(route)
+            route.add_forwarded(forwarded)
+            if forwarded:
+                status(f"Forwarded new {'album' if len(messages) > 1 else 'message'} ID {first_id}. Total: {route.forwarded}")
+            return
+        media = [m for m in messages if is_wanted_media(m, route.option("media_kinds"))]
+        route.add_skipped(len(messages) - len(media))
+        media = _drop_repeated_media(route, media)
+        if not media:
+            if route.backfill_done:
+                route.set_checkpoint(messages[-1].id)
+            return
+        try:
+            caption = await _send_with_caption(route, media, status, PRIORITY_LIVE)
+            route.add_forwarded(len(media))
+            status(f"Forwarded new {'album' if len(media) > 1 else 'media'} with caption '{caption}'. Total: {route.forwarded} (skipped: {route.skipped})")
+        except Exception as e:
+            route.add_failed(len(media))
+            status(f"ERROR sending new media from message ID {first_id}: {e}")
+
+
+class ForwardingSession:
+    """
+    A forwarding run as a task that can be stopped, paused and resumed while the
+    authenticated client stays connected.
+
+    start() runs a ForwardingEngine in its own task. stop() cancels only that task:
+    the engine flushes its progress and removes its event handlers, so a new session
+    can start right away without reconnecting and without handlers piling up.
+    """
+    def __init__(self, config, routes, status_callback):
+        self.engine = ForwardingEngine(config, routes, status_callback)
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    @property
+    def paused(self):
+        return self.engine.paused
+
+    def start(self):
+        if not client:
+            raise ConnectionError("Client not initialized.")
+        if not self.running:
+            self.task = asyncio.ensure_future(self.engine.run())
+            active_sessions.add(self)
+            self.task.add_done_callback(lambda _: active_sessions.discard(self))
+        return self
+
+    async def wait(self):
+        """Waits for the run to end. Cancelling the waiter stops the session."""
+        return await self.task
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def pause(self):
+        self.engine.pause()
+
+    def resume(self):
+        self.engine.resume()
+
+
+def start_session(config, mode=None, status_callback=print):
+    """
+    Starts and returns a ForwardingSession without waiting for it: the single pair
+    configured at the top level of config in `mode`, or the whole route table if
+    mode is None.
+    """
+    if mode is None:
+        routes = get_routes(config)
+        if not routes:
+            raise ValueError("No routes configured.")
+    else:
+        routes = [Route(config, config, mode)]
+    return ForwardingSession(config, routes, status_callback).start()
+
+async def start_forwarding(config, mode, status_callback):
+    """Forwards the single source/destination pair configured at the top level of config."""
+    if not client:
+        raise ConnectionError("Client not initialized.")
+    await start_session(config, mode, status_callback).wait()
+
+async def start_routes(config, status_callback):
+    """Forwards every enabled entry of the route table with one client and one set of handlers."""
+    if not client:
+        raise ConnectionError("Client not initialized.")
+    await start_session(config, None, status_callback).wait()
+
+def get_progress():
+    """Progress of the running forwarding (see ForwardingEngine.progress), or [] when idle."""
+    engine = current_engine
+    return engine.progress() if engine is not None else []
 
 async def stop_forwarding():
-    if client and client.is_connected():
-        await client.disconnect()
+    """Stops every running session. The client stays connected; use disconnect_client() to close it."""
+    for session in list(active_sessions):
+        await session.stop()
+    flush_state()
+
+async def clear_chat(chat_id, status_callback=None, min_id=0, max_id=0, since=None, until=None, concurrency=3):
+    """
+    Deletes the messages of a chat while streaming its history: IDs are collected
+    page by page into chunks of 100 and up to `concurrency` delete requests run at
+    once behind the "delete" rate limit, so memory stays flat on huge chats.
 
-async def clear_chat(chat_id):
+    An optional range limits the wipe to IDs strictly between min_id and max_id
+    and/or dates from `since` up to (not including) `until`. The scan starts at the
+    newest end of the range and stops at its oldest end, so a partial wipe never
+    walks the whole history.
+    """
     if not client:
         raise ConnectionError("Client not initialized.")
-    
-    message_ids = [msg.id async for msg in client.iter_messages(chat_id, limit=None)]
-    if not message_ids:
+
+    status = status_callback or (lambda text: None)
+    in_flight = asyncio.Semaphore(max(1, int(concurrency or 1)))
+    tasks = set()
+    failures = []
+    progress = {"deleted": 0, "reported": 0.0}
+    started = time.monotonic()
+
+    async def delete(chunk):
+        try:
+            await rate_limiter.call(chat_id, "delete", functools.partial(
+                client.delete_messages, input_peer(chat_id), chunk, revoke=True), status_callback)
+            progress["deleted"] += len(chunk)
+            now = time.monotonic()
+            if now - progress["reported"] >= 1.0: # At most one progress line per second
+                progress["reported"] = now
+                status(f"Deleted {progress['deleted']} messages ({progress['deleted'] / max(now - started, 1e-6):.1f} msg/s)...")
+        except Exception as e:
+            failures.append(e)
+        finally:
+            in_flight.release()
+
+    async def submit(chunk):
+        await in_flight.acquire()
+        if failures:
+            in_flight.release()
+            raise failures[0]
+        task = asyncio.ensure_future(delete(chunk))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    chunk = []
+    cursor = max_id # A read cut off by a FloodWait resumes below the last ID it read
+    attempt = 0
+    try:
+        while True:
+            try:
+                async for message in client.iter_messages(input_peer(chat_id), min_id=min_id, max_id=cursor, offset_date=until):
+                    if since is not None and message.date < since:
+                        break # Newest first: everything after this is older than the range
+                    chunk.append(message.id)
+                    cursor = message.id
+                    if len(chunk) == 100:
+                        await submit(chunk)
+                        chunk = []
+                break
+            except (FloodWaitError, FloodPremiumWaitError) as e:
+                if failures: # Raised by submit() for a failed delete, not by the read
+                    raise
+                attempt += 1
+                await _flood_sleep(e, attempt, "history", status_callback)
+        if chunk:
+            await submit(chunk)
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    if failures:
+        raise failures[0]
+
+    deleted = progress["deleted"]
+    if not deleted:
         return "No messages to delete."
-        
-    for i in range(0, len(message_ids), 100):
-        chunk = message_ids[i:i+100]
-        await client(DeleteMessagesRequest(id=chunk, revoke=True))
-    
-    return f"Successfully deleted {len(message_ids)} messages."
+    elapsed = time.monotonic() - started
+    return f"Successfully deleted {deleted} messages in {elapsed:.1f}s ({deleted / max(elapsed, 1e-6):.1f} msg/s)."
+
+# === File transfer ===
+def _hash_file(path, hasher, length=None):
+    """Feeds the first `length` bytes of a file (all of it by default) into hasher."""
+    remaining = os.path.getsize(path) if length is None else length
+    with open(path, "rb") as f:
+        while remaining > 0:
+            block = f.read(min(remaining, 1024 * 1024))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+
+async def download_file_parallel(message, path, workers=4, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Downloads the media of a message to path with up to `workers` chunks in flight and
+    returns its SHA-256. Worker i fetches chunks i, i + workers, ... and writes them
+    at their offsets, so a large file is not limited to one round trip per chunk.
+    """
+    size = message.file.size if message.file else None
+    chunks = max(1, (size + chunk_size - 1) // chunk_size) if size else 1
+    workers = max(1, min(workers, chunks)) if size else 1 # Without a size, stream it in one pass
+    with open(path, "wb") as f:
+        if size:
+            f.truncate(size)
+
+    async def fetch(first):
+        with open(path, "r+b") as f:
+            position = first * chunk_size
+            async for chunk in client.iter_download(message.media, offset=position, stride=workers * chunk_size,
+                                                    limit=(chunks - first + workers - 1) // workers,
+                                                    request_size=chunk_size, file_size=size):
+                f.seek(position)
+                f.write(chunk)
+                position += workers * chunk_size
+            f.flush()
+            os.fsync(f.fileno())
+
+    await asyncio.gather(*(fetch(first) for first in range(workers)))
+    hasher = hashlib.sha256()
+    _hash_file(path, hasher)
+    return hasher.hexdigest()
+
+async def upload_file_parallel(path, workers=4, part_size=UPLOAD_PART_SIZE, name=None):
+    """
+    Uploads a local file with up to `workers` file parts in flight at once and returns
+    the InputFile/InputFileBig handle to send it with. client.upload_file sends the
+    parts one after another, so a large file waits one round trip per 512 KB part.
+    """
+    size = os.path.getsize(path)
+    parts = max(1, (size + part_size - 1) // part_size)
+    big = size > BIG_FILE_SIZE
+    file_id = generate_random_long()
+    next_part = iter(range(parts))
+
+    async def upload_parts():
+        with open(path, "rb") as f:
+            for part in next_part: # Shared iterator: each part is taken by one worker
+                f.seek(part * part_size)
+                data = f.read(part_size)
+                if big:
+                    request = SaveBigFilePartRequest(file_id, part, parts, data)
+                else:
+                    request = SaveFilePartRequest(file_id, part, data)
+                saved = await _call_waiting(functools.partial(client, request), "upload") # Parts are not rate-limited
+                if not saved:
+                    raise RuntimeError(f"Telegram rejected part {part} of {path}")
+
+    await asyncio.gather(*(upload_parts() for _ in range(max(1, min(workers, parts)))))
+    name = name or os.path.basename(path)
+    if big:
+        return InputFileBig(file_id, parts, name)
+    md5 = hashlib.md5()
+    _hash_file(path, md5)
+    return InputFile(file_id, parts, name, md5.hexdigest())
+
+# === Re-upload for protected sources ===
+def get_media_cache(config):
+    """The on-disk media cache used by re-uploads, opened on first use."""
+    global media_cache
+    if media_cache is None:
+        media_cache = MediaCache(config.get("media_cache_dir") or MEDIA_CACHE_DIR,
+                                 int(config.get("media_cache_max_mb", 2048)) * 1024 * 1024)
+    return media_cache
+
+def close_media_cache():
+    global media_cache
+    if media_cache is not None:
+        media_cache.close()
+        media_cache = None
+
+def _media_key(message):
+    if message.photo:
+        return f"photo:{message.photo.id}"
+    return f"document:{message.document.id}"
+
+def _media_ref(sent_message):
+    """The uploaded photo/document of a sent message, serialized for the media cache."""
+    if sent_message is None or not (sent_message.photo or sent_message.document):
+        return None
+    media = sent_message.photo or sent_message.document
+    return json.dumps({"type": "photo" if sent_message.photo else "document", "id": media.id,
+                       "access_hash": media.access_hash, "file_reference": media.file_reference.hex()})
+
+def _ref_media(ref):
+    data = json.loads(ref)
+    args = (data["id"], data["access_hash"], bytes.fromhex(data["file_reference"]))
+    if data["type"] == "photo":
+        return InputMediaPhoto(InputPhoto(*args))
+    return InputMediaDocument(InputDocument(*args))
+
+def _uploaded_media(handle, message):
+    if message.photo:
+        return InputMediaUploadedPhoto(handle)
+    document = message.document
+    return InputMediaUploadedDocument(handle, document.mime_type, document.attributes)
+
+async def _reupload_media(route, message, status_callback, use_ref=True):
+    """
+    Returns (InputMedia, cache entry, sent by reference) for the media of a message
+    from a protected source. A file this account already uploaded is sent again by
+    reference. Otherwise it is uploaded from the cache, after a download into the
+    spill directory if the cache does not have it.
+    """
+    cache = get_media_cache(route.config)
+    key = _media_key(message)
+    entry = cache.lookup(key)
+    how = "cache"
+    if entry is None or (entry["path"] is None and not (use_ref and entry["ref"])):
+        spill = cache.spill_path(key)
+        try:
+            digest = await rate_limiter.call(route.source, "download", functools.partial(
+                download_file_parallel, message, spill, int(route.option("download_part_workers", 4))), status_callback)
+        except BaseException:
+            if os.path.exists(spill):
+                os.remove(spill)
+            raise
+        entry = cache.store(key, spill, digest, message.file.name if message.file else None)
+        how = "download"
+    if use_ref and entry["ref"]: # Also covers the same content under another media ID
+        metrics.inc("reuploads_total", how="reference")
+        return _ref_media(entry["ref"]), entry, True
+    handle = await upload_file_parallel(entry["path"], int(route.option("upload_part_workers", 4)),
+                                        name=entry["name"] or (message.file.name if message.file else None))
+    metrics.inc("reuploads_total", how=how)
+    return _uploaded_media(handle, message), entry, False
+
+async def _send_reuploaded(route, messages, caption, status_callback, priority):
+    """Sends the media of messages from a protected source through the media cache."""
+    prepared = [await _reupload_media(route, m, status_callback) for m in messages]
+    try:
+        sent = await _send_files(route, [media for media, _, _ in prepared], caption, status_callback, priority)
+    except (FileReferenceExpiredError, MediaEmptyError):
+        if not any(by_ref for _, _, by_ref in prepared):
+            raise
+        prepared = [await _reupload_media(route, m, status_callback, use_ref=False) for m in messages]
+        sent = await _send_files(route, [media for media, _, _ in prepared], caption, status_callback, priority)
+    cache = get_media_cache(route.config)
+    for (_, entry, _), sent_message in zip(prepared, sent):
+        ref = _media_ref(sent_message)
+        if ref is not None:
+            cache.set_ref(entry["sha256"], ref)
+    return sent
+
+# === Local archive export ===
+def archive_path(config, chat_id):
+    """Default archive folder of a chat: <archive_dir>/<chat ID>."""
+    return os.path.join(config.get("archive_dir") or "archives", str(chat_id))
+
+async def _download_file(message, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Streams the media of a message to path through path + PART_SUFFIX and returns
+    (size, sha256). An existing part file is kept up to the last whole chunk and the
+    download continues from there, so an interrupted file is not fetched again.
+    """
+    hasher = hashlib.sha256()
+    if os.path.exists(path): # Finished before the record was written
+        _hash_file(path, hasher)
+        return os.path.getsize(path), hasher.hexdigest()
+
+    part = path + PART_SUFFIX
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part) // chunk_size * chunk_size # Telegram needs aligned offsets
+        with open(part, "r+b") as f:
+            f.truncate(offset)
+        _hash_file(part, hasher)
+    with open(part, "ab") as f:
+        async for chunk in client.iter_download(message.media, offset=offset, request_size=chunk_size):
+            f.write(chunk)
+            hasher.update(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(part, path)
+    return os.path.getsize(path), hasher.hexdigest()
+
+def _media_attributes(message):
+    """Video/audio details of a document, kept so an import re-uploads it as the same kind of media."""
+    document = message.document
+    if document is None:
+        return None
+    attributes = {}
+    for attribute in document.attributes:
+        if isinstance(attribute, DocumentAttributeVideo):
+            attributes["video"] = {"duration": attribute.duration, "w": attribute.w, "h": attribute.h,
+                                   "round_message": bool(attribute.round_message),
+                                   "supports_streaming": bool(attribute.supports_streaming)}
+        elif isinstance(attribute, DocumentAttributeAudio):
+            attributes["audio"] = {"duration": attribute.duration, "voice": bool(attribute.voice),
+                                   "title": attribute.title, "performer": attribute.performer}
+        elif isinstance(attribute, DocumentAttributeAnimated):
+            attributes["animated"] = True
+    return attributes
+
+def _archive_record(message):
+    """The JSON record of one message in messages.jsonl."""
+    action = getattr(message, "action", None)
+    return {
+        "id": message.id,
+        "date": message.date.isoformat() if message.date else None,
+        "edit_date": message.edit_date.isoformat() if getattr(message, "edit_date", None) else None,
+        "sender_id": message.sender_id,
+        "reply_to": message.reply_to_msg_id,
+        "grouped_id": getattr(message, "grouped_id", None),
+        "text": getattr(message, "text", None) or "", # Markdown, with formatting entities applied
+        "service": type(action).__name__ if action is not None else None,
+        "media": None
+    }
+
+async def export_chat(config, chat_id, archive_dir=None, status_callback=None, download_media=True):
+    """
+    Streams the history of a chat into a local archive (see chat_archive.py):
+    one JSONL record per message plus the downloaded media files.
+
+    Messages are read in ascending order behind a bounded queue, up to
+    `export_download_workers` media downloads run at once behind the "download"
+    rate limit, and records are appended in ID order, so memory use does not grow
+    with the chat. A re-run only exports messages newer than the last record, and
+    resumes media files that were partially downloaded.
+    """
+    if not client:
+        raise ConnectionError("Client not initialized.")
+
+    status = status_callback or (lambda text: None)
+    archive_dir = archive_dir or archive_path(config, chat_id)
+    archive = ChatArchive(archive_dir)
+    source_chat = archive.manifest["source_chat"]
+    if source_chat is not None and source_chat != chat_id:
+        raise ValueError(f"{archive_dir} is an archive of chat {source_chat}, not {chat_id}.")
+    chat = get_dialog_directory().get(chat_id)
+    archive.manifest["source_chat"] = chat_id
+    archive.manifest["source_name"] = chat["name"] if chat else archive.manifest["source_name"]
+
+    await resolve_entities(config, [chat_id], status_callback)
+    if not active_sessions: # Reconfiguring would reset the buckets of running routes
+        rate_limiter.configure(config.get("rate_limits"), config.get("flood_wait_retries"))
+
+    after = archive.last_id()
+    status(f"Exporting {archive.manifest['source_name'] or chat_id} to {archive_dir} "
+           + (f"after message ID {after}..." if after else "from the first message..."))
+    progress = {"messages": 0, "bytes": 0, "failed": 0, "reported": 0.0}
+    started = time.monotonic()
+
+    async def prepare(message):
+        record = _archive_record(message)
+        if message.media is None or isinstance(message, MessageService):
+            return record
+        file = message.file
+        record["media"] = {
+            "kind": media_kind(message) or ("sticker" if message.sticker else type(message.media).__name__),
+            "file": None,
+            "name": file.name if file else None,
+            "mime_type": file.mime_type if file else None,
+            "size": file.size if file else None,
+            "sha256": None,
+            "key": _media_key(message) if message.photo or message.document else None,
+            "attributes": _media_attributes(message)
+        }
+        if download_media and (message.photo or message.document):
+            name = f"{message.id}{(file.ext if file else None) or ''}"
+            try:
+                size, digest = await rate_limiter.call(chat_id, "download", functools.partial(
+                    _download_file, message, archive.media_path(name)), status_callback)
+            except Exception as e: # Expired reference, unavailable media, network error...
+                # Recorded without its file, so one bad file does not stop this and every later export
+                record["media"]["error"] = f"{type(e).__name__}: {e}"
+                progress["failed"] += 1
+                part = archive.media_path(name) + PART_SUFFIX
+                if os.path.exists(part):
+                    os.remove(part)
+                status(f"ERROR downloading the media of message ID {message.id}: {e}. Archived without it.")
+                return record
+            record["media"].update(file=f"{archive.manifest['media_dir']}/{name}", size=size, sha256=digest)
+        return record
+
+    async def write(record):
+        archive.append(record)
+        progress["messages"] += 1
+        media = record["media"] or {}
+        if media.get("file"):
+            progress["bytes"] += media.get("size") or 0
+        now = time.monotonic()
+        if progress["messages"] % 500 == 0:
+            archive.save_manifest() # Bounds the recount needed after a crash
+        if now - progress["reported"] >= 1.0:
+            progress["reported"] = now
+            status(f"Exported {progress['messages']} messages, {progress['bytes'] / 1048576:.1f} MB of media "
+                   f"(last ID {record['id']}, {progress['messages'] / max(now - started, 1e-6):.1f} msg/s)...")
+
+    try:
+        history = iter_history(chat_id, after, workers=int(config.get("history_workers") or 1),
+                               range_size=int(config.get("history_range_size") or 1000), status_callback=status_callback)
+        await run_pipeline(history, write,
+                           prepare=prepare, queue_size=config.get("export_queue_size", 50),
+                           workers=config.get("export_download_workers", 4), name=f"export:{chat_id}")
+    finally:
+        archive.close()
+
+    exported = progress["messages"]
+    if not exported:
+        return f"Archive {archive_dir} is up to date ({archive.manifest['messages']} messages)."
+    elapsed = time.monotonic() - started
+    failed = f" {progress['failed']} media files could not be downloaded." if progress["failed"] else ""
+    return (f"Exported {exported} messages and {progress['bytes'] / 1048576:.1f} MB of media to {archive_dir} "
+            f"in {elapsed:.1f}s. The archive now holds {archive.manifest['messages']} messages.{failed}")
+
+# === Archive import ===
+class ArchiveRoute(Route):
+    """
+    A route from a local archive to a destination chat. It uses the archive's source
+    chat for the message index, so messages already forwarded from the live chat are
+    not posted again. Its checkpoint is kept apart from the live route's under
+    "archive:...", and its caption counter lives in config["archive_imports"] under
+    the same key (journaled with `index` set to that key), so an import never uses
+    or advances the configured pair's counter.
+    """
+    shares_counter = False
+
+    def __init__(self, config, archive, destination, mode, start_count=1):
+        self.archive = archive
+        self._destination = destination
+        self.mode = mode
+        settings = config.setdefault("archive_imports", {}).setdefault(self.key, {})
+        settings.setdefault("prefix", config.get("prefix", "Caption"))
+        settings.setdefault("count", start_count)
+        super().__init__(config, settings, mode, index=self.key)
+
+    @property
+    def source(self):
+        return self.archive.manifest["source_chat"]
+
+    @property
+    def destination(self):
+        return self._destination
+
+    @property
+    def key(self):
+        return f"archive:{self.source}:{self.destination}:{self.mode}"
+
+    @property
+    def label(self):
+        return f"{self.archive.manifest.get('source_name') or self.archive.path} (archive) -> {self.destination}"
+
+def _input_media(handle, media):
+    """The InputMedia for an uploaded archive file, with the attributes recorded at export."""
+    if media.get("kind") == "photo":
+        return InputMediaUploadedPhoto(handle)
+    recorded = media.get("attributes") or {}
+    attributes = [DocumentAttributeFilename(media.get("name") or handle.name)]
+    if "video" in recorded:
+        attributes.append(DocumentAttributeVideo(**recorded["video"]))
+    if "audio" in recorded:
+        attributes.append(DocumentAttributeAudio(**recorded["audio"]))
+    if recorded.get("animated"):
+        attributes.append(DocumentAttributeAnimated())
+    return InputMediaUploadedDocument(handle, media.get("mime_type") or "application/octet-stream", attributes)
+
+async def _send_archived(route, messages, status_callback):
+    """Re-posts one archived message, or the media of one album, with the original text."""
+    destination = route.destination
+    reply_to = None
+    if messages[0].reply_to_msg_id and route.option("duplicate_check", True):
+        # Point replies at the copy of the original message, if it reached this destination
+        for chat, message_id, _ in open_message_index(route.config).lookup(route.source, messages[0].reply_to_msg_id):
+            if chat == destination:
+                reply_to = message_id
+    if messages[0].media is not None:
+        files = [m.media for m in messages]
+        captions = [m.text for m in messages]
+        sent = await rate_limiter.call(destination, "send", functools.partial(
+            client.send_file, input_peer(destination), file=files if len(files) > 1 else files[0],
+            caption=captions if len(captions) > 1 else captions[0], reply_to=reply_to), status_callback)
+    else:
+        sent = await rate_limiter.call(destination, "send", functools.partial(
+            client.send_message, input_peer(destination), messages[0].text, reply_to=reply_to), status_callback)
+    if not isinstance(sent, list):
+        sent = [sent]
+    for message, sent_message in zip(messages, sent):
+        _record_forwarded(route, message, sent_message)
+    route.set_checkpoint(messages[-1].id)
+    state_writer.record(route)
+
+async def import_archive(config, archive_dir, destination, mode, status_callback=None, start_count=1):
+    """
+    Clones an archive written by export_chat into a destination chat, in message order.
+
+    Mode '1' re-posts every message with its original text and media; mode '2' posts
+    only the media kinds in `media_kinds`, with the custom caption. Each import into a
+    destination numbers on its own counter, from `start_count` the first time. The
+    archive is streamed from disk, up to `import_upload_workers` files are uploaded
+    ahead of the send stage (each with `upload_part_workers` parts in flight), and
+    sends go through the "send" rate limit. The checkpoint is journaled after every
+    send, so an interrupted import resumes after the last message it posted.
+    """
+    if not client:
+        raise ConnectionError("Client not initialized.")
+
+    status = status_callback or (lambda text: None)
+    archive = ChatArchive(archive_dir)
+    if archive.manifest["source_chat"] is None:
+        raise ValueError(f"{archive_dir} does not contain an exported chat.")
+    route = ArchiveRoute(config, archive, destination, mode, start_count)
+    media_kinds = set(route.option("media_kinds") or MEDIA_FILTERS)
+    part_workers = int(config.get("upload_part_workers", 4))
+
+    await resolve_entities(config, [destination], status_callback)
+    if not active_sessions: # Reconfiguring would reset the buckets of running routes
+        rate_limiter.configure(config.get("rate_limits"), config.get("flood_wait_retries"))
+    state_writer.configure(config)
+
+    checkpoint = route.checkpoint()
+    status(f"Importing {route.label}" + (f", resuming after message ID {checkpoint}..." if checkpoint else "..."))
+
+    async def records():
+        for record in archive.iter_records(min_id=checkpoint):
+            yield ArchivedMessage(record, archive)
+
+    async def import_units():
+        # Albums stay together; in mode '1' messages without a downloaded file are sent as text
+        async for group in group_albums(records()):
+            if mode == '1':
+                media = [m for m in group if m.media is not None]
+                units = ([media] if media else []) + [[m] for m in group if m.media is None and m.text]
+            else:
+                media = [m for m in group if m.media is not None and m.media_info.get("kind") in media_kinds]
+                units = [media] if media else []
+            route.add_skipped(len(group) - sum(len(unit) for unit in units))
+            for unit in units:
+                duplicates = _already_forwarded(route, unit)
+                if duplicates:
+                    route.add_skipped(len(duplicates))
+                    unit = [m for m in unit if m.id not in duplicates]
+                if mode == '2':
+                    unit = _drop_repeated_media(route, unit) # Before the upload, so a repeat costs no transfer
+                if unit:
+                    yield unit
+
+    async def upload(unit):
+        try:
+            for message in unit:
+                if message.media is not None:
+                    handle = await upload_file_parallel(message.media, part_workers)
+                    message.media = _input_media(handle, message.media_info)
+        except Exception as e:
+            return unit, e # Reported by the send stage, in order
+        return unit, None
+
+    async def send(prepared):
+        unit, error = prepared
+        try:
+            if error is not None:
+                raise error
+            if mode == '1':
+                await _send_archived(route, unit, status_callback)
+                route.add_forwarded(len(unit))
+                status(f"Imported message ID {unit[-1].id}. Total: {route.forwarded}")
+            else:
+                last_id = unit[-1].id
+                unit = _drop_repeated_media(route, unit) # Repeats of a file still in the upload queue
+                if not unit:
+                    route.set_checkpoint(last_id)
+                    return
+                caption = await _send_with_caption(route, unit, status_callback)
+                route.add_forwarded(len(unit))
+                status(f"Imported {'album' if len(unit) > 1 else 'media'} with caption '{caption}'. Total: {route.forwarded}")
+        except Exception as e:
+            route.add_failed(len(unit))
+            status(f"ERROR importing message ID {unit[0].id}: {e}")
+
+    try:
+        await run_pipeline(import_units(), send, prepare=upload,
+                           queue_size=int(config.get("import_queue_size", 10)),
+                           workers=int(config.get("import_upload_workers", 2)), name=route.key)
+    finally:
+        flush_state()
+    return f"Import finished: {route.forwarded} messages posted, {route.skipped} skipped."
 
 async def logout():
     """
@@ -162,17 +2310,24 @@ async def logout():
     config = load_configuration()
     config['api_id'] = None
     config['api_hash'] = None
+    clear_entities(config) # Access hashes belong to the logged-out account
     save_configuration(config)
 
-    # Delete session file
+    # Delete session file and the cached chat list of this account
     if os.path.exists(SESSION_FILE):
         os.remove(SESSION_FILE)
+    get_dialog_directory().clear()
     
     print("Successfully logged out and cleared session.")
 
 
 async def disconnect_client():
     global client
+    await stop_forwarding()
+    close_message_index()
+    close_media_cache()
+    close_media_dedup()
+    await metrics.close()
     if client and client.is_connected():
         await client.disconnect()
     client = None
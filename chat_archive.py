@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+import time
+
+# === Local chat archive ===
+# <archive>/manifest.json   summary of the archive (source chat, last ID, counts)
+# <archive>/messages.jsonl  one JSON record per message, in ascending ID order
+# <archive>/media/          downloaded media files, named after the message ID
+ARCHIVE_FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+MESSAGES_FILE = "messages.jsonl"
+MEDIA_DIR = "media"
+PART_SUFFIX = ".part" # Media downloads in progress; resumed by the next export
+
+
+class ArchivedMessage:
+    """
+    A record of the archive in the shape of a Telethon message (id, grouped_id, text,
+    media), so the forwarding helpers can send it. `media` starts as the path of the
+    downloaded file, or None, and is replaced by the uploaded file when importing.
+    """
+    def __init__(self, record, archive):
+        self.record = record
+        self.id = record["id"]
+        self.grouped_id = record.get("grouped_id")
+        self.reply_to_msg_id = record.get("reply_to")
+        self.text = record.get("text") or ""
+        self.date = None # Not a live post, so it is kept out of the latency histogram
+        media = record.get("media") or {}
+        self.media_info = media
+        self.media = os.path.join(archive.path, media["file"]) if media.get("file") else None
+
+
+class ChatArchive:
+    """
+    An append-only archive of one chat on disk.
+
+    Records are appended to messages.jsonl as they are exported, so memory use does
+    not depend on the size of the chat, and a re-run continues after the last
+    complete record. The manifest is rewritten atomically from time to time and on
+    close, and can be used to verify or re-import the archive.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, MEDIA_DIR), exist_ok=True)
+        self.messages_path = os.path.join(path, MESSAGES_FILE)
+        self.manifest = {
+            "format": ARCHIVE_FORMAT,
+            "source_chat": None,
+            "source_name": None,
+            "created": None,
+            "updated": None,
+            "first_id": None,
+            "last_id": 0,
+            "messages": 0,
+            "media_files": 0,
+            "media_bytes": 0,
+            "messages_file": MESSAGES_FILE,
+            "media_dir": MEDIA_DIR
+        }
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.manifest.update(json.load(f))
+        self._writer = None
+
+    def media_path(self, name):
+        return os.path.join(self.path, MEDIA_DIR, name)
+
+    def last_id(self):
+        """
+        ID of the last complete record. A record cut off by a crash is dropped, and
+        the manifest counters are brought in line with the records on disk.
+        """
+        if not os.path.exists(self.messages_path):
+            return 0
+        with open(self.messages_path, "rb+") as f:
+            position = f.seek(0, os.SEEK_END)
+            tail = b""
+            while position > 0 and tail.count(b"\n") < 2: # Enough to hold the last complete line
+                step = min(65536, position)
+                position -= step
+                f.seek(position)
+                tail = f.read(step) + tail
+            if tail and not tail.endswith(b"\n"):
+                cut = tail.rfind(b"\n") + 1 # Drop the partial last line
+                f.truncate(position + cut)
+                tail = tail[:cut]
+        lines = tail.splitlines()
+        last = json.loads(lines[-1]) if lines else None
+        if last is None:
+            return 0
+        if last["id"] > self.manifest["last_id"]:
+            self.recount() # The manifest is behind the records (crash between manifest writes)
+        return last["id"]
+
+    def recount(self):
+        """Recomputes the manifest counters from messages.jsonl, streaming it once."""
+        messages = media_files = media_bytes = 0
+        first_id = last_id = None
+        for record in self.iter_records():
+            messages += 1
+            first_id = record["id"] if first_id is None else first_id
+            last_id = record["id"]
+            media = record.get("media") or {}
+            if media.get("file"):
+                media_files += 1
+                media_bytes += media.get("size") or 0
+        self.manifest.update(messages=messages, media_files=media_files, media_bytes=media_bytes,
+                             first_id=first_id, last_id=last_id or 0)
+
+    def append(self, record):
+        if self._writer is None:
+            self._writer = open(self.messages_path, "a", encoding="utf-8")
+        self._writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+        manifest = self.manifest
+        manifest["messages"] += 1
+        manifest["last_id"] = record["id"]
+        if manifest["first_id"] is None:
+            manifest["first_id"] = record["id"]
+        media = record.get("media") or {}
+        if media.get("file"):
+            manifest["media_files"] += 1
+            manifest["media_bytes"] += media.get("size") or 0
+
+    def iter_records(self, min_id=0):
+        """Streams the records with an ID above min_id, in archive order."""
+        if not os.path.exists(self.messages_path):
+            return
+        with open(self.messages_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["id"] > min_id:
+                    yield record
+
+    def save_manifest(self):
+        """Flushes appended records, then rewrites the manifest atomically."""
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        self.manifest["created"] = self.manifest["created"] or now
+        self.manifest["updated"] = now
+        fd, temp_path = tempfile.mkstemp(prefix=".manifest.", suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.manifest, f, indent=2)
+            os.replace(temp_path, os.path.join(self.path, MANIFEST_FILE))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def close(self):
+        self.save_manifest()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+
+# === Persisted dialog directory ===
+DIALOG_CACHE_FILE = "dialog_cache.json"
+
+
+class DialogDirectory:
+    """
+    On-disk cache of the account's dialogs with an ID index and a name index.
+
+    The cache is returned instantly at startup and refreshed incrementally:
+    Telegram lists dialogs by last activity, so a refresh only walks the dialogs
+    that changed since `synced_date` (plus the pinned ones, which always come first).
+    A full refresh also drops dialogs the account has left.
+    """
+    def __init__(self, path=DIALOG_CACHE_FILE):
+        self.path = path
+        self.synced_date = 0 # Newest dialog activity (unix time) seen by the last refresh
+        self.by_id = {}
+        self.by_name = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return # A broken cache is simply rebuilt by the next refresh
+        self.synced_date = data.get("synced_date", 0)
+        self.by_id = {chat["id"]: chat for chat in data.get("chats", [])}
+        self._reindex()
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".dialog_cache.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"synced_date": self.synced_date, "chats": self.chats()}, f)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _reindex(self):
+        self.by_name = {}
+        for chat in self.by_id.values():
+            self.by_name.setdefault(chat["name"], []).append(chat["id"])
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def chats(self):
+        """All cached chats, most recently active first."""
+        return sorted(self.by_id.values(), key=lambda chat: chat.get("date") or 0, reverse=True)
+
+    def get(self, chat_id):
+        return self.by_id.get(chat_id)
+
+    def label(self, chat):
+        """Display name that is unique across the directory: duplicate names get their ID appended."""
+        if len(self.by_name.get(chat["name"], [])) > 1:
+            return f"{chat['name']} ({chat['id']})"
+        return chat["name"]
+
+    def labels(self):
+        """Returns {label: chat ID} for every chat, in display order."""
+        return {self.label(chat): chat["id"] for chat in self.chats()}
+
+    def update(self, chats, full=False):
+        """Merges refreshed chats into the directory. A full refresh replaces it."""
+        if full:
+            self.by_id = {}
+        for chat in chats:
+            self.by_id[chat["id"]] = chat
+            self.synced_date = max(self.synced_date, chat.get("date") or 0)
+        self._reindex()
+
+    def clear(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.synced_date = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
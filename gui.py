@@ -39,6 +39,107 @@ import bot_backend
 import threading
 import asyncio
 import queue
+import collections
+import datetime
+import time
+
+STATUS_MAX_LINES = 500 # Lines kept in the status box; older ones are dropped
+STATUS_FLUSHES_PER_SECOND = 4 # How often forwarding status is written to the status box
+STATUS_LINES_PER_FLUSH = 20 # Newest lines shown per flush; the rest are summarised
+RESULTS_PER_DRAIN = 100 # UI callbacks run per wake-up before yielding back to Tk
+
+class StatusStream:
+    """
+    Buffers forwarding status lines between the asyncio thread and the status box.
+
+    push() may be called from any thread and only appends to a small bounded buffer.
+    While forwarding runs, the Tk side flushes that buffer a few times per second:
+    it writes the newest lines (noting how many were left out) and refreshes the
+    forwarded/skipped/rate/ETA counters from bot_backend.get_progress().
+    """
+    def __init__(self, frame):
+        self.frame = frame
+        self.pending = collections.deque(maxlen=STATUS_LINES_PER_FLUSH)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._sample = None # (time, forwarded, position) at the previous flush
+        self.rate = 0.0 # Forwarded messages per second, smoothed
+        self.id_rate = 0.0 # Source message IDs covered per second, smoothed (for the ETA)
+
+    def push(self, message):
+        with self._lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(message)
+
+    def start(self):
+        self._sample = None
+        self.rate = self.id_rate = 0.0
+        if self._timer is None:
+            self._timer = self.frame.after(1000 // STATUS_FLUSHES_PER_SECOND, self._tick)
+
+    def stop(self):
+        if self._timer is not None:
+            self.frame.after_cancel(self._timer)
+            self._timer = None
+        self.flush()
+
+    def _tick(self):
+        self._timer = None
+        self.flush()
+        self._timer = self.frame.after(1000 // STATUS_FLUSHES_PER_SECOND, self._tick)
+
+    def flush(self):
+        with self._lock:
+            lines, dropped = list(self.pending), self.dropped
+            self.pending.clear()
+            self.dropped = 0
+        if dropped:
+            lines.insert(0, f"... {dropped} status lines skipped ...")
+        if lines:
+            self.frame.append_status_lines(lines)
+        self.frame.update_counters(self.counters())
+
+    def counters(self):
+        progress = bot_backend.get_progress()
+        forwarded = sum(p["forwarded"] for p in progress)
+        skipped = sum(p["skipped"] for p in progress)
+        position = sum(p["position"] for p in progress if p["backfilling"])
+        remaining = sum(max(0, p["target"] - p["position"]) for p in progress if p["backfilling"])
+        now = time.monotonic()
+        if self._sample is not None and now > self._sample[0] and forwarded >= self._sample[1]:
+            elapsed = now - self._sample[0]
+            self.rate = 0.7 * self.rate + 0.3 * (forwarded - self._sample[1]) / elapsed
+            self.id_rate = 0.7 * self.id_rate + 0.3 * max(0, position - self._sample[2]) / elapsed
+        self._sample = (now, forwarded, position) if progress else None # Rates restart with the next run
+
+        if not progress:
+            eta = "-"
+        elif not any(p["backfilling"] for p in progress):
+            eta = "backfill done"
+        elif self.id_rate > 0:
+            eta = str(datetime.timedelta(seconds=int(remaining / self.id_rate)))
+        else:
+            eta = "estimating..."
+        return f"Forwarded: {forwarded}   Skipped: {skipped}   Rate: {self.rate:.1f} msg/s   ETA: {eta}"
+
+
+class TaskHandle:
+    """A coroutine running on the background event loop, as seen from the Tk thread."""
+    def __init__(self, future):
+        self.future = future
+
+    def cancel(self):
+        """Cancels the asyncio task. Its cancel_callback (if any) then runs on the Tk thread."""
+        return self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    def cancelled(self):
+        return self.future.cancelled()
+
 
 class App(ctk.CTk):
     def __init__(self):
@@ -53,13 +154,16 @@ class App(ctk.CTk):
         # Load config
         self.config = bot_backend.load_configuration()
         self.chats = []
-        self.forwarding_thread = None
 
-        # Placeholder for new asyncio thread management
+        # Background asyncio loop; its results reach Tk through result_queue (see call_in_ui)
         self.async_loop = None
         self.async_thread = None
-        self.task_queue = queue.Queue()
         self.result_queue = queue.Queue()
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_pending = False
+        self._closing = False # Set by on_closing; no results are delivered once the window is going away
+        self._closed = False
+        self.bind("<<AsyncResults>>", self._drain_results)
         self._start_async_thread()
 
         api_id = self.config.get("api_id")
@@ -71,7 +175,7 @@ class App(ctk.CTk):
             self.main_frame.grid(row=0, column=0, padx=20, pady=20, sticky="nsew")
             self.run_async_task(
                 self._async_auto_login(api_id, api_hash),
-                callback=lambda client: self.main_frame.update_status("Auto-login successful."),
+                callback=self._auto_login_succeeded,
                 error_callback=self._auto_login_failed
             )
         else:
@@ -93,6 +197,10 @@ class App(ctk.CTk):
             on_password_request=raise_exception_on_call
         )
     
+    def _auto_login_succeeded(self, client):
+        self.main_frame.update_status("Auto-login successful.")
+        self.main_frame.fetch_chats(force_refresh=False) # Bring the cached chat list up to date in the background
+
     def _auto_login_failed(self, error):
         self.main_frame.update_status(f"Auto-login failed: {error}")
         self.main_frame.destroy()
@@ -109,53 +217,101 @@ class App(ctk.CTk):
 
 
     def _start_async_thread(self):
+        # The loop is created here so it exists before the first run_async_task call
+        self.async_loop = asyncio.new_event_loop()
         self.async_thread = threading.Thread(target=self._run_async_loop, daemon=True)
         self.async_thread.start()
-        # Start a periodic check for results from the async thread
-        self.after(100, self._check_async_results)
 
     def _run_async_loop(self):
-        self.async_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.async_loop)
         self.async_loop.run_forever()
 
-    def _check_async_results(self):
-        while not self.result_queue.empty():
+    def call_in_ui(self, callback, *args):
+        """
+        Runs callback(*args) on the Tk thread. Safe to call from any thread; the UI is
+        woken up once per batch of results instead of polling for them.
+        """
+        if self._closed:
+            return # The Tk thread is shutting down and may be waiting for this thread
+        self.result_queue.put((callback, args))
+        with self._wakeup_lock:
+            if self._wakeup_pending:
+                return # A wake-up is already on its way and will drain this result too
+            self._wakeup_pending = True
+        try:
+            self.event_generate("<<AsyncResults>>", when="tail")
+        except Exception:
+            # The window is being destroyed or not running yet: let the next result try again
+            with self._wakeup_lock:
+                self._wakeup_pending = False
+
+    def _drain_results(self, event=None):
+        with self._wakeup_lock:
+            self._wakeup_pending = False
+        for _ in range(RESULTS_PER_DRAIN):
             try:
-                callback, args, kwargs = self.result_queue.get_nowait()
-                callback(*args, **kwargs)
+                callback, args = self.result_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(*args)
             except Exception as e:
                 print(f"Error processing async result: {e}")
-        self.after(100, self._check_async_results)
+        self.after_idle(self._drain_results) # More results left: continue after Tk has redrawn
 
-    def run_async_task(self, coro, callback=None, error_callback=None):
+    def run_async_task(self, coro, callback=None, error_callback=None, cancel_callback=None):
+        """
+        Schedules coro on the background loop and returns a TaskHandle. The callbacks run
+        on the Tk thread with the result, the exception, or nothing if it was cancelled.
+        """
         future = asyncio.run_coroutine_threadsafe(coro, self.async_loop)
 
         def _on_done(f):
-            try:
-                result = f.result()
+            if f.cancelled():
+                if cancel_callback:
+                    self.call_in_ui(cancel_callback)
+                return
+            error = f.exception()
+            if error is None:
                 if callback:
-                    self.result_queue.put((callback, (result,), {}))
-            except Exception as e:
-                if error_callback:
-                    self.result_queue.put((error_callback, (e,), {}))
-                else:
-                    print(f"Unhandled async task error: {e}")
-        
+                    self.call_in_ui(callback, f.result())
+            elif error_callback:
+                self.call_in_ui(error_callback, error)
+            else:
+                print(f"Unhandled async task error: {error}")
+
         future.add_done_callback(_on_done)
+        return TaskHandle(future)
 
 
     def show_main_app(self):
         self.login_frame.destroy()
         self.main_frame = MainApplicationFrame(self)
         self.main_frame.grid(row=0, column=0, padx=20, pady=20, sticky="nsew")
+        self.main_frame.fetch_chats(force_refresh=False)
 
     def on_closing(self):
-        try:
-            # Disconnect client first
-            # The disconnect_client is an async function, needs to be run in the async loop
-            self.run_async_task(bot_backend.disconnect_client())
+        if self._closing:
+            return
+        self._closing = True
+        # Disconnect first, on the async loop, without blocking the Tk thread: stopping a running
+        # forwarding delivers its callbacks through call_in_ui, which needs this thread to be free.
+        # The window is destroyed once the disconnect is done, or after 5 seconds at most.
+        self.run_async_task(
+            bot_backend.disconnect_client(),
+            callback=lambda _: self._finish_closing(),
+            error_callback=lambda e: self._finish_closing(e),
+            cancel_callback=self._finish_closing
+        )
+        self.after(5000, self._finish_closing)
 
+    def _finish_closing(self, error=None):
+        if self._closed:
+            return
+        self._closed = True
+        if error is not None:
+            print(f"Error during graceful shutdown: {error}")
+        try:
             # Stop the async loop
             if self.async_loop and self.async_loop.is_running():
                 self.async_loop.call_soon_threadsafe(self.async_loop.stop)
@@ -232,7 +388,7 @@ class LoginFrame(ctk.CTkFrame):
 
                 dialog.protocol("WM_DELETE_WINDOW", on_cancel) # Handle window close button
                 
-            self.parent.after(0, show_dialog)
+            self.parent.call_in_ui(show_dialog)
             return await future
 
         async def get_phone():
@@ -291,12 +447,18 @@ class MainApplicationFrame(ctk.CTkFrame):
         self.chats_frame.grid(row=2, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
         self.chats_frame.grid_columnconfigure(0, weight=1)
         self.chats_frame.grid_columnconfigure(1, weight=1)
-        self.fetch_chats_button = ctk.CTkButton(self.chats_frame, text="Fetch Chats", command=self.fetch_chats)
+        self.fetch_chats_button = ctk.CTkButton(self.chats_frame, text="Fetch Chats", command=lambda: self.fetch_chats(force_refresh=True))
         self.fetch_chats_button.grid(row=0, column=0, columnspan=2, pady=10)
         self.source_chat_menu = ctk.CTkOptionMenu(self.chats_frame, values=["- Select Source -"], command=self.update_config)
         self.source_chat_menu.grid(row=1, column=0, padx=10, pady=10, sticky="ew")
         self.destination_chat_menu = ctk.CTkOptionMenu(self.chats_frame, values=["- Select Destination -"], command=self.update_config)
         self.destination_chat_menu.grid(row=1, column=1, padx=10, pady=10, sticky="ew")
+        self.add_route_button = ctk.CTkButton(self.chats_frame, text="Save as Route", command=self.add_route)
+        self.add_route_button.grid(row=2, column=0, padx=10, pady=10)
+        self.all_routes_var = ctk.BooleanVar(value=False)
+        self.all_routes_checkbox = ctk.CTkCheckBox(self.chats_frame, variable=self.all_routes_var)
+        self.all_routes_checkbox.grid(row=2, column=1, padx=10, pady=10, sticky="w")
+        self.update_routes_label()
 
         # === Status & Control Frame ===
         self.control_frame = ctk.CTkFrame(self)
@@ -304,21 +466,40 @@ class MainApplicationFrame(ctk.CTkFrame):
         self.control_frame.grid_columnconfigure(0, weight=1)
         self.start_button = ctk.CTkButton(self.control_frame, text="Start Forwarding", command=self.start_forwarding)
         self.start_button.grid(row=0, column=0, padx=5, pady=10)
+        self.pause_button = ctk.CTkButton(self.control_frame, text="Pause", state="disabled", command=self.toggle_pause)
+        self.pause_button.grid(row=0, column=1, padx=5, pady=10)
         self.stop_button = ctk.CTkButton(self.control_frame, text="Stop Forwarding", state="disabled", command=self.stop_forwarding)
-        self.stop_button.grid(row=0, column=1, padx=5, pady=10)
+        self.stop_button.grid(row=0, column=2, padx=5, pady=10)
         self.logout_button = ctk.CTkButton(self.control_frame, text="Logout", command=self.logout)
-        self.logout_button.grid(row=0, column=2, padx=5, pady=10)
+        self.logout_button.grid(row=0, column=3, padx=5, pady=10)
         self.status_box = ctk.CTkTextbox(self.control_frame)
-        self.status_box.grid(row=1, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
+        self.status_box.grid(row=1, column=0, columnspan=4, padx=10, pady=10, sticky="nsew")
         self.control_frame.grid_rowconfigure(1, weight=1)
+        self.counters_label = ctk.CTkLabel(self.control_frame, text="")
+        self.counters_label.grid(row=2, column=0, columnspan=4, padx=10, pady=(0, 10), sticky="w")
+        self.status_stream = StatusStream(self)
+        self.forwarding_task = None # TaskHandle of the running forwarding, if any
+        self.session = None # bot_backend.ForwardingSession of the running forwarding
 
         self.toggle_custom_caption_ui()
+        self.chat_ids = {} # Menu label -> chat ID
+        self.show_chats(bot_backend.get_cached_chats()) # Cached list right away, refreshed after login
 
     def update_status(self, message):
+        self.append_status_lines([message])
+
+    def append_status_lines(self, lines):
         self.status_box.configure(state="normal")
-        self.status_box.insert("end", message + "\n")
+        self.status_box.insert("end", "\n".join(lines) + "\n")
+        # Keep only the newest STATUS_MAX_LINES lines
+        line_count = int(self.status_box.index("end-1c").split(".")[0]) - 1
+        if line_count > STATUS_MAX_LINES:
+            self.status_box.delete("1.0", f"{line_count - STATUS_MAX_LINES + 1}.0")
         self.status_box.yview_moveto(1.0)
 
+    def update_counters(self, text):
+        self.counters_label.configure(text=text)
+
     def toggle_custom_caption_ui(self):
         if self.mode_var.get() == "2":
             self.custom_caption_frame.grid(row=2, column=0, padx=10, pady=10, sticky="nsew")
@@ -327,92 +508,148 @@ class MainApplicationFrame(ctk.CTkFrame):
             self.custom_caption_frame.grid_remove()
             self.chats_frame.grid(row=2, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
 
-    def fetch_chats(self):
+    def fetch_chats(self, force_refresh=True):
+        """Refreshes the chat list: only recently active chats, or everything with force_refresh."""
         self.fetch_chats_button.configure(state="disabled", text="Fetching...")
         self.parent.run_async_task(
-            self._async_fetch_chats(),
+            self._async_fetch_chats(force_refresh),
             callback=self.fetch_chats_success,
             error_callback=self.fetch_chats_error
         )
 
-    async def _async_fetch_chats(self):
-        return await bot_backend.get_chats()
+    async def _async_fetch_chats(self, force_refresh):
+        return await bot_backend.get_chats(force_refresh=force_refresh)
 
     def fetch_chats_success(self, chats):
-        self.parent.chats = chats
-        chat_names = [chat['name'] for chat in chats]
-        self.source_chat_menu.configure(values=chat_names)
-        self.destination_chat_menu.configure(values=chat_names)
+        self.show_chats(chats)
         self.fetch_chats_button.configure(state="normal", text="Fetch Chats")
 
+    def show_chats(self, chats):
+        self.parent.chats = chats
+        self.chat_ids = bot_backend.get_dialog_directory().labels() # Duplicate names are labelled with their ID
+        if self.chat_ids:
+            self.source_chat_menu.configure(values=list(self.chat_ids))
+            self.destination_chat_menu.configure(values=list(self.chat_ids))
+
     def fetch_chats_error(self, error):
         self.update_status(f"Error fetching chats: {error}")
         self.fetch_chats_button.configure(state="normal", text="Fetch Chats")
 
     def reset_counter(self):
         self.parent.config["count"] = 1
+        bot_backend.clear_checkpoints(self.parent.config, mode='2') # Numbering restarts from the first media message
+        bot_backend.forget_forwarded(self.parent.config) # Otherwise the message index skips everything already posted
         bot_backend.save_configuration(self.parent.config)
-        self.update_status("Counter reset to 1.")
+        self.update_status("Counter reset to 1. Custom Caption backfill will start from the beginning and post every message again.")
 
     def update_config(self, _=None):
         pass
 
-    def start_forwarding(self):
-        src_name = self.source_chat_menu.get()
-        dest_name = self.destination_chat_menu.get()
+    def update_routes_label(self):
+        count = len(bot_backend.get_routes(self.parent.config))
+        self.all_routes_checkbox.configure(text=f"Forward all saved routes ({count})")
+
+    def apply_chat_selection(self):
+        """Copies the selected chats into the config. Returns False if the selection is invalid."""
+        src_id = self.chat_ids.get(self.source_chat_menu.get())
+        dest_id = self.chat_ids.get(self.destination_chat_menu.get())
 
-        if src_name == "- Select Source -" or dest_name == "- Select Destination -":
+        if src_id is None or dest_id is None:
             self.update_status("Error: Please select both a source and a destination chat.")
-            return
-        if src_name == dest_name:
+            return False
+        if src_id == dest_id:
             self.update_status("Error: Source and destination chats cannot be the same.")
-            return
-            
-        self.parent.config["source_name"] = src_name
-        self.parent.config["source_channel"] = next(c['id'] for c in self.parent.chats if c['name'] == src_name)
-        self.parent.config["destination_name"] = dest_name
-        self.parent.config["destination_channel"] = next(c['id'] for c in self.parent.chats if c['name'] == dest_name)
+            return False
+
+        directory = bot_backend.get_dialog_directory()
+        self.parent.config["source_name"] = directory.get(src_id)['name']
+        self.parent.config["source_channel"] = src_id
+        self.parent.config["destination_name"] = directory.get(dest_id)['name']
+        self.parent.config["destination_channel"] = dest_id
         self.parent.config["prefix"] = self.prefix_entry.get()
+        return True
+
+    def add_route(self):
+        if not self.apply_chat_selection():
+            return
+        config = self.parent.config
+        bot_backend.add_route(config, config["source_channel"], config["destination_channel"], self.mode_var.get(),
+                              config["source_name"], config["destination_name"], config["prefix"])
+        bot_backend.save_configuration(config)
+        self.update_routes_label()
+        self.update_status(f"Route saved: {config['source_name']} -> {config['destination_name']}.")
+
+    def start_forwarding(self):
+        if self.all_routes_var.get():
+            if not bot_backend.get_routes(self.parent.config):
+                self.update_status("Error: No saved routes. Use \"Save as Route\" first.")
+                return
+        elif not self.apply_chat_selection():
+            return
 
         bot_backend.save_configuration(self.parent.config)
         self.update_status("Configuration saved.")
 
         self.start_button.configure(state="disabled")
         self.stop_button.configure(state="normal")
-        
-        self.parent.run_async_task(
-            self._async_start_forwarding(),
-            error_callback=lambda e: self.after(0, self.forwarding_error, e)
+        self.pause_button.configure(state="normal", text="Pause")
+        self.status_stream.start()
+
+        # Tk variables are read here, on the Tk thread, not inside the coroutine
+        task = self.forwarding_task = self.parent.run_async_task(
+            self._async_start_forwarding(self.all_routes_var.get(), self.mode_var.get()),
+            callback=lambda _: self.forwarding_stopped(task),
+            error_callback=lambda error: self.forwarding_error(error, task),
+            cancel_callback=lambda: self.forwarding_stopped(task)
         )
 
-    async def _async_start_forwarding(self):
-        # The status_callback needs to post to the main thread for UI updates
-        def gui_status_callback(msg):
-            self.after(0, self.update_status, msg)
-        
-        try:
-            await bot_backend.start_forwarding(self.parent.config, self.mode_var.get(), gui_status_callback)
-        finally:
-            self.after(0, self.forwarding_stopped)
+    async def _async_start_forwarding(self, all_routes, mode):
+        # Status lines are buffered and written to the status box a few times per second
+        gui_status_callback = self.status_stream.push
+
+        # The session only owns its task and handlers; Stop leaves the client connected
+        self.session = bot_backend.start_session(self.parent.config, None if all_routes else mode, gui_status_callback)
+        await self.session.wait()
 
-    def forwarding_error(self, error):
+    def forwarding_error(self, error, task=None):
         self.update_status(f"An error occurred during forwarding: {error}")
-        self.forwarding_stopped()
+        self.forwarding_stopped(task)
 
+    def toggle_pause(self):
+        session = self.session
+        if session is None:
+            return
+        if self.pause_button.cget("text") == "Resume":
+            self.parent.async_loop.call_soon_threadsafe(session.resume)
+            self.pause_button.configure(text="Pause")
+            self.update_status("Forwarding resumed.")
+        else:
+            self.parent.async_loop.call_soon_threadsafe(session.pause)
+            self.pause_button.configure(text="Resume")
+            self.update_status("Forwarding paused. New messages are queued until you resume.")
 
     def stop_forwarding(self):
         self.update_status("Stopping forwarding...")
         self.stop_button.configure(state="disabled")
-        self.parent.run_async_task(
-            self._async_stop_forwarding(),
-            error_callback=lambda e: self.after(0, self.update_status, f"Error stopping: {e}")
-        )
-
-    async def _async_stop_forwarding(self):
-        await bot_backend.stop_forwarding()
-        self.after(0, self.forwarding_stopped)
-
-    def forwarding_stopped(self):
+        self.pause_button.configure(state="disabled")
+        session, task = self.session, self.forwarding_task
+        if session is not None:
+            # Start is only re-enabled once the engine has removed its handlers and flushed its progress
+            self.parent.run_async_task(
+                session.stop(),
+                callback=lambda _: self.forwarding_stopped(task),
+                error_callback=lambda error: self.forwarding_error(error, task)
+            )
+        elif self.forwarding_task is not None:
+            self.forwarding_task.cancel() # Not started yet: nothing to unwind
+
+    def forwarding_stopped(self, task=None):
+        if task is not self.forwarding_task:
+            return # Already reported (by stop() or the run ending), or a run that has been replaced
+        self.forwarding_task = None
+        self.session = None
+        self.pause_button.configure(state="disabled", text="Pause")
+        self.status_stream.stop()
         self.update_status("Forwarding stopped.")
         self.start_button.configure(state="normal")
         self.stop_button.configure(state="disabled")
@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+# === Content-addressed media cache ===
+MEDIA_CACHE_DIR = "media_cache"
+SPILL_DIR = "spill" # Downloads in progress, moved into the cache once complete
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media_keys (
+    media_key TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS media_files (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    name TEXT,
+    cached INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    ref TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS media_files_lru ON media_files (cached, last_used);
+"""
+
+
+class MediaCache:
+    """
+    On-disk cache of downloaded media, bounded to `max_bytes` and evicted least
+    recently used first.
+
+    Files are stored once per SHA-256 of their content, and Telegram media IDs
+    (for example "document:<id>") point at the hash, so the same file posted
+    several times, or under several IDs, is downloaded and stored once. After the
+    first upload, the uploaded copy is kept as `ref` so the file can be sent again
+    by reference without any transfer. Evicting a file keeps its ref.
+    """
+    def __init__(self, path=MEDIA_CACHE_DIR, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        spill = os.path.join(path, SPILL_DIR)
+        os.makedirs(spill, exist_ok=True)
+        for name in os.listdir(spill): # Downloads cut off by a crash
+            os.remove(os.path.join(spill, name))
+        self._db = sqlite3.connect(os.path.join(path, "index.db"))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self.cached_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM media_files WHERE cached = 1").fetchone()[0]
+
+    def file_path(self, sha256):
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def spill_path(self, media_key):
+        """A new temporary file for one download (concurrent downloads of a file do not share it)."""
+        fd, path = tempfile.mkstemp(prefix=media_key.replace(":", "_") + ".", dir=os.path.join(self.path, SPILL_DIR))
+        os.close(fd)
+        return path
+
+    def lookup(self, media_key):
+        """
+        Returns {"sha256", "size", "name", "path", "ref"} for a media ID, or None.
+        `path` is None when the file was evicted. A hit counts as a use.
+        """
+        row = self._db.execute(
+            "SELECT f.sha256, f.size, f.name, f.cached, f.ref FROM media_keys k JOIN media_files f ON f.sha256 = k.sha256 "
+            "WHERE k.media_key = ?", (media_key,)).fetchone()
+        if row is None:
+            return None
+        sha256, size, name, cached, ref = row
+        path = self.file_path(sha256) if cached else None
+        if path is not None and not os.path.exists(path): # Removed behind our back
+            path = None
+            self._uncache(sha256, size)
+        with self._db:
+            self._db.execute("UPDATE media_files SET last_used = ? WHERE sha256 = ?", (time.time(), sha256))
+        return {"sha256": sha256, "size": size, "name": name, "path": path, "ref": ref}
+
+    def store(self, media_key, temp_path, sha256, name=None):
+        """
+        Moves a finished download into the cache under its content hash and maps
+        media_key to it. Other files are evicted if the cache is over its size.
+        """
+        size = os.path.getsize(temp_path)
+        path = self.file_path(sha256)
+        row = self._db.execute("SELECT cached FROM media_files WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is not None and row[0] and os.path.exists(path):
+            os.remove(temp_path) # Same content under another ID: keep the copy we have
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            self.cached_bytes += size
+        with self._db:
+            self._db.execute(
+                "INSERT INTO media_files (sha256, size, name, cached, last_used, ref) VALUES (?, ?, ?, 1, ?, NULL) "
+                "ON CONFLICT (sha256) DO UPDATE SET cached = 1, last_used = excluded.last_used",
+                (sha256, size, name, time.time()))
+            self._db.execute("INSERT OR REPLACE INTO media_keys VALUES (?, ?)", (media_key, sha256))
+        self.evict(keep=sha256)
+        return self.lookup(media_key)
+
+    def set_ref(self, sha256, ref):
+        with self._db:
+            self._db.execute("UPDATE media_files SET ref = ? WHERE sha256 = ?", (ref, sha256))
+
+    def _uncache(self, sha256, size):
+        path = self.file_path(sha256)
+        if os.path.exists(path):
+            os.remove(path)
+        self.cached_bytes -= size
+        with self._db:
+            self._db.execute("UPDATE media_files SET cached = 0 WHERE sha256 = ?", (sha256,))
+
+    def evict(self, keep=None):
+        """Removes least recently used files until the cache fits in max_bytes."""
+        while self.cached_bytes > self.max_bytes:
+            row = self._db.execute(
+                "SELECT sha256, size FROM media_files WHERE cached = 1 AND sha256 != ? ORDER BY last_used LIMIT 1",
+                (keep or "",)).fetchone()
+            if row is None:
+                break # Only the file in use is left
+            self._uncache(*row)
+        with self._db: # Entries with neither a file nor a ref are useless
+            self._db.execute("DELETE FROM media_keys WHERE sha256 IN (SELECT sha256 FROM media_files WHERE cached = 0 AND ref IS NULL)")
+            self._db.execute("DELETE FROM media_files WHERE cached = 0 AND ref IS NULL")
+
+    def close(self):
+        self._db.close()
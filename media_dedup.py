@@ -0,0 +1,94 @@
+import collections
+import sqlite3
+import time
+
+# === Posted media index (duplicate suppression) ===
+MEDIA_DEDUP_FILE = "media_dedup.db"
+COMMIT_EVERY = 200 # Changes buffered before they are written in one transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posted_media (
+    destination_chat INTEGER NOT NULL,
+    identity TEXT NOT NULL,
+    posted REAL NOT NULL,
+    PRIMARY KEY (destination_chat, identity)
+) WITHOUT ROWID
+"""
+
+
+class MediaDedupIndex:
+    """
+    Media identities (for example "document:<id>", "sha256:<hash>") already posted to
+    each destination, used to skip reposts of the same file.
+
+    The live set is held in memory, oldest post first, so a check is a dict lookup.
+    Entries older than `window_days` (0 keeps them forever) expire, and at most
+    `max_entries` are kept: the oldest are evicted first. Changes are written to
+    SQLite in batched transactions and the set is reloaded from it on start.
+    """
+    def __init__(self, path=MEDIA_DEDUP_FILE, window_days=0, max_entries=1000000, commit_every=COMMIT_EVERY):
+        self.path = path
+        self.window = float(window_days or 0) * 86400
+        self.max_entries = max(1, int(max_entries))
+        self.commit_every = commit_every
+        self._posted = collections.OrderedDict() # (destination, identity) -> posted time, oldest first
+        self._pending = {}
+        self._evicted = []
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT destination_chat, identity, posted FROM posted_media WHERE posted >= ? ORDER BY posted DESC LIMIT ?",
+            (self._cutoff(), self.max_entries)).fetchall()
+        for destination, identity, posted in reversed(rows):
+            self._posted[(destination, identity)] = posted
+        with self._db: # Drop what did not make it into memory so the file stays bounded too
+            self._db.execute("DELETE FROM posted_media WHERE posted < ?", (rows[-1][2] if len(rows) == self.max_entries else self._cutoff(),))
+
+    def _cutoff(self):
+        return time.time() - self.window if self.window else 0
+
+    def _expire(self):
+        cutoff = self._cutoff()
+        while self._posted:
+            key, posted = next(iter(self._posted.items()))
+            if posted >= cutoff and len(self._posted) <= self.max_entries:
+                break
+            self._posted.popitem(last=False)
+            self._pending.pop(key, None)
+            self._evicted.append(key)
+
+    def __len__(self):
+        return len(self._posted)
+
+    def is_posted(self, destination, identities):
+        """True if any of the identities was posted to destination within the window."""
+        self._expire()
+        return any((destination, identity) in self._posted for identity in identities)
+
+    def add(self, destination, identities):
+        now = time.time()
+        for identity in identities:
+            key = (destination, identity)
+            self._posted.pop(key, None)
+            self._posted[key] = now # Reposting refreshes the entry
+            self._pending[key] = now
+        self._expire()
+        if len(self._pending) + len(self._evicted) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if not self._pending and not self._evicted:
+            return
+        with self._db:
+            self._db.executemany("DELETE FROM posted_media WHERE destination_chat = ? AND identity = ?", self._evicted)
+            self._db.executemany("INSERT OR REPLACE INTO posted_media VALUES (?, ?, ?)",
+                                 [key + (posted,) for key, posted in self._pending.items()])
+        self._pending.clear()
+        self._evicted = []
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,136 @@
+import csv
+import os
+import sqlite3
+import sys
+
+# === Source -> destination message ID index ===
+INDEX_FILE = "message_index.db"
+COMMIT_EVERY = 200 # Rows buffered before they are written in one transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS message_map (
+    source_chat INTEGER NOT NULL,
+    source_id INTEGER NOT NULL,
+    destination_chat INTEGER NOT NULL,
+    destination_id INTEGER,
+    caption_number INTEGER,
+    PRIMARY KEY (source_chat, source_id, destination_chat)
+) WITHOUT ROWID
+"""
+
+
+class MessageIndex:
+    """
+    Persistent map of (source chat, source message ID) to the message(s) it produced
+    in each destination chat.
+
+    The table is a clustered B-tree on its primary key, so lookups stay O(log n) at
+    tens of millions of rows. New rows are buffered and written in batched
+    transactions; buffered rows are visible to lookups before they are committed.
+    """
+    def __init__(self, path=INDEX_FILE, commit_every=COMMIT_EVERY):
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = {}
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+        self._db.commit()
+
+    def add(self, source_chat, source_id, destination_chat, destination_id, caption_number=None):
+        self._pending[(source_chat, source_id, destination_chat)] = (destination_id, caption_number)
+        if len(self._pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if not self._pending:
+            return
+        rows = [key + value for key, value in self._pending.items()]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO message_map VALUES (?, ?, ?, ?, ?)", rows)
+        self._pending.clear()
+
+    def forwarded_ids(self, source_chat, source_ids, destination_chat):
+        """Returns the subset of source_ids that already have a copy in destination_chat."""
+        source_ids = list(source_ids)
+        found = {i for i in source_ids if (source_chat, i, destination_chat) in self._pending}
+        for start in range(0, len(source_ids), 500): # Stay below SQLite's bound parameter limit
+            chunk = source_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._db.execute(
+                f"SELECT source_id FROM message_map WHERE source_chat = ? AND destination_chat = ? AND source_id IN ({placeholders})",
+                [source_chat, destination_chat] + chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def lookup(self, source_chat, source_id):
+        """Returns [(destination_chat, destination_id, caption_number), ...] for one source message."""
+        self.commit()
+        return self._db.execute(
+            "SELECT destination_chat, destination_id, caption_number FROM message_map WHERE source_chat = ? AND source_id = ?",
+            (source_chat, source_id)).fetchall()
+
+    def lookup_many(self, source_chat, source_ids):
+        """Returns [(source_id, destination_chat, destination_id, caption_number), ...] for several source messages."""
+        self.commit()
+        source_ids = list(source_ids)
+        rows = []
+        for start in range(0, len(source_ids), 500):
+            chunk = source_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(self._db.execute(
+                f"SELECT source_id, destination_chat, destination_id, caption_number FROM message_map WHERE source_chat = ? AND source_id IN ({placeholders})",
+                [source_chat] + chunk))
+        return rows
+
+    def remove(self, source_chat, source_ids, destination_chat=None):
+        self.commit()
+        with self._db:
+            if destination_chat is None:
+                self._db.executemany("DELETE FROM message_map WHERE source_chat = ? AND source_id = ?",
+                                     [(source_chat, i) for i in source_ids])
+            else:
+                self._db.executemany("DELETE FROM message_map WHERE source_chat = ? AND source_id = ? AND destination_chat = ?",
+                                     [(source_chat, i, destination_chat) for i in source_ids])
+
+    def forget(self, source_chat, destination_chat):
+        """Removes every copy made from source_chat in destination_chat."""
+        self._pending = {key: value for key, value in self._pending.items() if key[0] != source_chat or key[2] != destination_chat}
+        with self._db:
+            self._db.execute("DELETE FROM message_map WHERE source_chat = ? AND destination_chat = ?", (source_chat, destination_chat))
+
+    def iter_rows(self, source_chat=None):
+        self.commit()
+        if source_chat is None:
+            return self._db.execute("SELECT * FROM message_map ORDER BY source_chat, source_id")
+        return self._db.execute("SELECT * FROM message_map WHERE source_chat = ? ORDER BY source_id", (source_chat,))
+
+    def export_csv(self, path, source_chat=None):
+        """Writes the mapping as a CSV report. Returns the number of rows written."""
+        count = 0
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["source_chat", "source_id", "destination_chat", "destination_id", "caption_number"])
+            for row in self.iter_rows(source_chat):
+                writer.writerow(row)
+                count += 1
+        return count
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+if __name__ == "__main__":
+    # Usage: python message_index.py export <report.csv> [source_chat_id]
+    if len(sys.argv) < 3 or sys.argv[1] != "export":
+        print("Usage: python message_index.py export <report.csv> [source_chat_id]")
+        sys.exit(1)
+    if not os.path.exists(INDEX_FILE):
+        print(f"No index found at {INDEX_FILE}.")
+        sys.exit(1)
+    index = MessageIndex()
+    written = index.export_csv(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    index.close()
+    print(f"Exported {written} mappings to {sys.argv[2]}.")
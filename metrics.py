@@ -0,0 +1,149 @@
+import asyncio
+import math
+
+# === Metrics registry ===
+PREFIX = "telegram_forwarder"
+# Source post -> destination post latency buckets (seconds): live lag up to day-old backfill
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400)
+
+METRICS = {
+    "forwarded_total": ("counter", "Messages forwarded or re-posted to a destination."),
+    "skipped_total": ("counter", "Source messages skipped (unwanted media kind, service message or duplicate)."),
+    "media_duplicates_total": ("counter", "Media skipped because the same file was already posted to the destination."),
+    "failed_total": ("counter", "Messages that could not be sent after all retries."),
+    "api_calls_total": ("counter", "Rate-limited Telegram requests, by request type."),
+    "flood_waits_total": ("counter", "FloodWait/SlowMode replies received, by request type."),
+    "flood_wait_seconds_total": ("counter", "Seconds Telegram asked us to wait, by request type."),
+    "reuploads_total": ("counter", "Media from protected sources sent by reference, from the cache or after a download."),
+    "queue_depth": ("gauge", "Items waiting in a forwarding queue."),
+    "latency_seconds": ("histogram", "Time from the source post to its copy in the destination."),
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    In-process counters, histograms and queue gauges.
+
+    Everything is a no-op until `enabled` is set, so the instrumentation calls in
+    the forwarding paths cost one attribute check when metrics are off. Queue depths
+    are read from the tracked queues when a snapshot is taken, not on every put/get.
+    Use from the event loop thread.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+        self.queues = {} # (name, labels) -> asyncio.Queue
+        self._server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def track_queue(self, name, queue, **labels):
+        if self.enabled:
+            self.queues[self._key(name, labels)] = queue
+
+    def untrack_queue(self, name, **labels):
+        self.queues.pop(self._key(name, labels), None)
+
+    def snapshot(self):
+        """Returns {"counters": ..., "gauges": ..., "histograms": ...}, keyed by metric name then label tuple."""
+        snapshot = {"counters": {}, "gauges": {}, "histograms": {}}
+        for (name, labels), value in list(self.counters.items()):
+            snapshot["counters"].setdefault(name, {})[labels] = value
+        for (name, labels), queue in list(self.queues.items()):
+            snapshot["gauges"].setdefault(name, {})[labels] = queue.qsize()
+        for (name, labels), histogram in list(self.histograms.items()):
+            cumulative, buckets = 0, {}
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                buckets[bound] = cumulative
+            buckets[math.inf] = histogram[-1]
+            snapshot["histograms"].setdefault(name, {})[labels] = {
+                "buckets": buckets, "sum": histogram[-2], "count": histogram[-1]}
+        return snapshot
+
+    def render(self):
+        """The current values in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            section = "histograms" if kind == "histogram" else "gauges" if kind == "gauge" else "counters"
+            series = snapshot[section].get(name)
+            if not series:
+                continue
+            full_name = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+                    continue
+                for bound, count in value["buckets"].items():
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', le),))} {count}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {value['sum']}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    # === HTTP endpoint ===
+    async def serve(self, host="127.0.0.1", port=9464):
+        """Serves GET /metrics on the running event loop. Starting it twice is a no-op."""
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass # Headers are not needed
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found. Metrics are served at /metrics.\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
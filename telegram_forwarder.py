@@ -140,21 +140,24 @@ async def configure_chats(config):
             sys.exit(1)
         return config
 
+    force_refresh = bool(bot_backend.get_cached_chats()) and get_user_confirmation("Reload the full chat list from Telegram? (Otherwise only recently active chats are refreshed)")
     print_info("Fetching your chats...")
     try:
-        chats = await bot_backend.get_chats()
+        chats = await bot_backend.get_chats(force_refresh=force_refresh)
         for chat in chats:
             print(f"  - Name: {chat['name']} ({chat['type']}), ID: {chat['id']}")
     except Exception as e:
         print_error(f"Could not fetch chats: {e}")
         sys.exit(1)
+    directory = bot_backend.get_dialog_directory()
 
     while True:
         try:
             src_id = int(input("Enter the SOURCE chat ID: "))
-            if any(c for c in chats if c['id'] == src_id):
+            chat = directory.get(src_id)
+            if chat:
                 config["source_channel"] = src_id
-                config["source_name"] = next(c['name'] for c in chats if c['id'] == src_id)
+                config["source_name"] = chat['name']
                 break
             else:
                 print_error("ID not found.")
@@ -167,9 +170,10 @@ async def configure_chats(config):
             if dest_id == config["source_channel"]:
                 print_error("Destination cannot be the same as source.")
                 continue
-            if any(c for c in chats if c['id'] == dest_id):
+            chat = directory.get(dest_id)
+            if chat:
                 config["destination_channel"] = dest_id
-                config["destination_name"] = next(c['name'] for c in chats if c['id'] == dest_id)
+                config["destination_name"] = chat['name']
                 break
             else:
                 print_error("ID not found.")
@@ -180,6 +184,22 @@ async def configure_chats(config):
     print_success("Chats selected.")
     return config
 
+def configure_routes(config, mode):
+    """Optionally saves the selected pair to the route table. Returns True to forward all saved routes."""
+    if get_user_confirmation("Save this source/destination pair to the route table?"):
+        bot_backend.add_route(config, config["source_channel"], config["destination_channel"], mode,
+                              config["source_name"], config["destination_name"], config["prefix"])
+        bot_backend.save_configuration(config)
+        print_success("Route saved.")
+
+    routes = bot_backend.get_routes(config)
+    if not routes:
+        return False
+    print_info("Saved routes:")
+    for route in routes:
+        print(f"  - {route.label} ({'Original' if route.mode == '1' else 'Custom'} Caption)")
+    return get_user_confirmation(f"Forward all {len(routes)} saved routes instead of only the selected pair?")
+
 async def main():
     display_welcome_screen()
     check_system_requirements()
@@ -192,20 +212,36 @@ async def main():
     await cli_login(config)
     
     mode = select_forwarding_mode()
-    
+    start_over = False # Forget what the chosen pair already forwarded, once the chats are chosen
+
     if mode == '2':
         if get_user_confirmation(f"Current prefix is '{config['prefix']}'. Change it?"):
             config["prefix"] = input("Enter new prefix: ").strip()
         if get_user_confirmation(f"Current counter is {config['count']}. Reset to 1?"):
             config["count"] = 1
+            bot_backend.clear_checkpoints(config, mode='2') # Numbering restarts from the first media message
+            start_over = True
         bot_backend.save_configuration(config)
 
     config = await configure_chats(config)
+
+    checkpoint = bot_backend.get_checkpoint(config, mode)
+    if checkpoint and not get_user_confirmation(f"Resume backfill after message ID {checkpoint}? (No posts every message again)"):
+        bot_backend.reset_checkpoint(config, mode)
+        bot_backend.save_configuration(config)
+        start_over = True
+    if start_over: # Otherwise the message index skips everything already posted
+        bot_backend.forget_forwarded(config)
     
+    run_routes = configure_routes(config, mode)
+
     print_header("Step 7: Configuration Summary")
-    print(f"  - Mode: {'Original' if mode == '1' else 'Custom'}")
-    print(f"  - Source: {config['source_name']}")
-    print(f"  - Destination: {config['destination_name']}")
+    if run_routes:
+        print(f"  - Routes: {len(bot_backend.get_routes(config))} saved routes")
+    else:
+        print(f"  - Mode: {'Original' if mode == '1' else 'Custom'}")
+        print(f"  - Source: {config['source_name']}")
+        print(f"  - Destination: {config['destination_name']}")
     if not get_user_confirmation("Start forwarding?"):
         sys.exit(0)
 
@@ -215,7 +251,10 @@ async def main():
     try:
         print_header("Step 8: Live Forwarding Status")
         print_info("Press CTRL + C to stop.")
-        await bot_backend.start_forwarding(config, mode, status_callback)
+        if run_routes:
+            await bot_backend.start_routes(config, status_callback)
+        else:
+            await bot_backend.start_forwarding(config, mode, status_callback)
     except KeyboardInterrupt:
         print_info("\nKeyboardInterrupt detected. Stopping forwarding...")
         await bot_backend.stop_forwarding() # Explicitly call stop_forwarding
@@ -223,12 +262,20 @@ async def main():
         print_info("\nForwarding task cancelled.")
     finally:
         print_info("\nForwarding stopped.")
+        if get_user_confirmation("Export the SOURCE chat to a local archive (messages and media)?"):
+            try:
+                result = await bot_backend.export_chat(config, config["source_channel"], status_callback=print_info)
+                print_success(result)
+            except Exception as e:
+                print_error(f"Export failed: {e}")
         if get_user_confirmation("WARNING: This will permanently delete ALL messages from the SOURCE chat. Continue?"):
             print_info("Clearing source chat history...")
-            await bot_backend.clear_chat(config["source_channel"])
+            result = await bot_backend.clear_chat(config["source_channel"], print_info, concurrency=config.get("clear_concurrency", 3))
+            print_success(result)
         if get_user_confirmation("WARNING: This will permanently delete ALL messages from the DESTINATION chat. Continue?"):
             print_info("Clearing destination chat history...")
-            await bot_backend.clear_chat(config["destination_channel"])
+            result = await bot_backend.clear_chat(config["destination_channel"], print_info, concurrency=config.get("clear_concurrency", 3))
+            print_success(result)
         
         await bot_backend.disconnect_client()
         print_success("Process finished.")